@@ -0,0 +1,323 @@
+import argparse
+import asyncio
+import cv2
+import numpy as np
+import os
+import tempfile
+import timeit
+import tracemalloc
+
+from imagestack import *
+
+# the font bundled for the tests, unless another one is given
+BENCHMARK_FONT = os.environ.get('IMAGESTACK_TEST_FONT',
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'Aileron-Regular.ttf'))
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def call_async(cor):
+    loop = asyncio.new_event_loop()
+    result = loop.run_until_complete(cor)
+    loop.close()
+    return result
+
+
+def report(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print('{:<50} {:>10.3f} ms'.format(name, seconds * 1000))
+
+
+def report_peak(name, func):
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{:<50} {:>10.1f} MB'.format(name, peak / 1024 / 1024))
+
+
+def text_layers(rows, background_color):
+    layers = []
+    for i in range(rows):
+        layer = TextLayer(
+            text='Player {} - {} points'.format(i, 12345 + i),
+            color=(255, 255, 255),
+            background_color=background_color,
+            background_padding=(4, 2),
+            font_size=16,
+        )
+        layer._init()
+        layers.append(layer)
+    return layers
+
+
+@benchmark
+def text_heavy(number):
+    # the text layers are rasterized directly, so no sprite cache or compositing is measured
+    image_creator = ImageCreator(fonts={'default': BENCHMARK_FONT})
+    for background_color, label in [((0, 0, 0, 0), 'transparent'), ((0, 0, 255, 255), 'opaque')]:
+        layers = text_layers(50, background_color)
+
+        def rasterize():
+            visitor = VisitorCreate(image_creator)
+            for layer in layers:
+                image_creator.buffers.release(visitor.visit_TextLayer(layer))
+
+        report('text_heavy 50 text layers, {} background'.format(label), rasterize, number)
+
+
+@benchmark
+def load_memory(number):
+    with tempfile.TemporaryDirectory() as path:
+        for n in range(200):
+            img = np.random.randint(0, 255, (256, 256, 4), dtype=np.uint8)
+            cv2.imwrite(os.path.join(path, '{}.png'.format(n)), img)
+
+        number = max(1, number // 10)
+        report('load_memory 200 images, serial',
+               lambda: ImageCreator(load_memory=[DirectoryImageLoader(path)]), number)
+        report('load_memory 200 images, 8 workers',
+               lambda: ImageCreator(load_memory=[DirectoryImageLoader(path, workers=8)]), number)
+        report('load_memory 200 images, lazy',
+               lambda: ImageCreator(load_memory=[DirectoryImageLoader(path)], lazy_memory=True), number)
+
+
+@benchmark
+def resize(number):
+    img = np.random.randint(0, 255, (2048, 2048, 4), dtype=np.uint8)
+    report('resize 2048 -> 128, cv2 default', lambda: cv2.resize(img, (128, 128)), number)
+    report('resize 2048 -> 128, INTER_AREA', lambda: resize_image(img, (128, 128)), number)
+    mipmaps = build_mipmaps(img)
+    report('resize 2048 -> 128, INTER_AREA from mipmap', lambda: resize_image(img, (128, 128), mipmaps=mipmaps), number)
+    resize_cache = ResizeCache()
+    img.flags.writeable = False
+    report('resize 2048 -> 128, cached variant', lambda: resize_cache.get(img, (128, 128)), number)
+
+
+@benchmark
+def reduced_decode(number):
+    img = np.random.randint(0, 255, (3000, 4000, 3), dtype=np.uint8)
+    img = cv2.GaussianBlur(img, (9, 9), 0)
+    jpeg = cv2.imencode('.jpg', img)[1].tobytes()
+    report('decode 4000x3000 jpeg for 128px, full', lambda: resize_image(read_image(jpeg), (128, 128)), number)
+    report('decode 4000x3000 jpeg for 128px, reduced',
+           lambda: resize_image(read_image(jpeg, (128, 128)), (128, 128)), number)
+
+
+@benchmark
+def gradient(number):
+    for axis in [0, 1]:
+        color = LinearGradientColor((255, 0, 0), (0, 0, 255, 128), axis=axis)
+        report('gradient 1500x1000 axis {}, create'.format(axis), lambda: color.create((1000, 1500, 4)), number)
+        report('gradient 1500x1000 axis {}, broadcast view'.format(axis),
+               lambda: color.create_broadcast((1000, 1500)), number)
+
+
+@benchmark
+def colored(number):
+    mask = np.random.randint(0, 256, (1000, 1500), dtype=np.uint8)
+    for color in [(255, 0, 0), (255, 0, 0, 128), LinearGradientColor((255, 0, 0), (0, 0, 255, 128))]:
+        layer = ColorLayer(color=color)
+        layer._init()
+        report('colored 1500x1000 {}'.format(type(layer.color).__name__), lambda: layer.colored(mask), number)
+
+
+@benchmark
+def rectangle(number):
+    masks = LRUCache(max_bytes=32 * 1024 * 1024)
+    for size, radius, line_width in [((400, 60), 20, -1), ((400, 60), 20, 3), ((1200, 800), 40, -1)]:
+        label = '{}x{} r={} w={}'.format(size[0], size[1], radius, line_width)
+        report('rectangle cv2 ' + label, lambda: draw_rounded_rectangle(size, radius, line_width), number)
+        report('rectangle sdf ' + label, lambda: sdf_rounded_rectangle(size, radius, line_width), number)
+        report('rectangle cached ' + label, lambda: rounded_rectangle_mask(size, radius, line_width, cache=masks), number)
+
+
+@benchmark
+def pie(number):
+    image_creator = ImageCreator(fonts={'default': BENCHMARK_FONT})
+    stack = ImageStack([PieLayer(radius=300, border_width=6, line_width=2, color=(255, 255, 255), choices=[
+        ImageStack([TextLayer(text='Choice {}'.format(i % 6), color=(255, 0, 0), font_size=24)]) for i in range(36)
+    ])])
+    stack._init()
+    report('pie 36 slices, first render',
+           lambda: (image_creator.sprites.clear(), call_async(stack.create(image_creator))), number)
+    report('pie 36 slices, cached sprites', lambda: call_async(stack.create(image_creator)), number)
+
+
+@benchmark
+def list_layer(number):
+    image_creator = ImageCreator()
+    for rows in [10, 100, 500]:
+        stack = ImageStack([ListLayer(repeat=rows, margin=2, template=ImageStack([
+            RectangleLayer(size=(400, 24), radius=6, color=(40, 40, 40)),
+            RectangleLayer(size=(200, 24), radius=6, color=(0, 200, 0)),
+        ]))])
+        stack._init()
+        report('list_layer {} rows'.format(rows), lambda: call_async(stack.create(image_creator)), number)
+
+
+@benchmark
+def masks(number):
+    w, h = 2000, 1500
+    line = LineLayer(target=(w, h), line_width=5, color=(255, 0, 0, 128))
+    line._init()
+    fill = ColorLayer(resize=(w, h), color=(255, 0, 0, 128))
+    fill._init()
+
+    def line_bgra():
+        src = np.zeros((h, w, 4), dtype=np.uint8)
+        cv2.line(src, (0, 0), (w, h), ALPHA_COLOR, 5, LINE_TYPE)
+        return line.colored(src)
+
+    def line_mask():
+        src = np.zeros((h, w), dtype=np.uint8)
+        cv2.line(src, (0, 0), (w, h), 255, 5, LINE_TYPE)
+        return line.colored(src)
+
+    cases = [
+        ('line 2000x1500', line_bgra, line_mask),
+        ('rectangle 2000x1500', lambda: line.colored(cv2.merge([draw_rounded_rectangle((w, h), 80, 5)] * 4)),
+         lambda: line.colored(draw_rounded_rectangle((w, h), 80, 5))),
+        ('color 2000x1500', lambda: fill.colored(np.full((h, w, 4), ALPHA_COLOR, dtype=np.uint8)),
+         lambda: fill.colored(full_mask((h, w)))),
+    ]
+    for name, bgra, mask in cases:
+        report('masks {}, bgra buffer'.format(name), bgra, number)
+        report('masks {}, single channel'.format(name), mask, number)
+        report_peak('masks {}, bgra buffer peak'.format(name), bgra)
+        report_peak('masks {}, single channel peak'.format(name), mask)
+
+
+@benchmark
+def premultiplied(number):
+    layers = [ColorLayer(resize=(1500, 1000), color=(30, 30, 30))]
+    for i in range(20):
+        layers.append(RectangleLayer(size=(600, 400), radius=30, color=(40 * i % 255, 100, 200, 128), pos=(i * 40, i * 25)))
+    stack = ImageStack(layers)
+    stack._init()
+    for premultiplied in [False, True]:
+        image_creator = ImageCreator(premultiplied=premultiplied)
+        report('premultiplied={}, 20 translucent layers 1500x1000'.format(premultiplied),
+               lambda: call_async(stack.create(image_creator)), number)
+
+
+@benchmark
+def dirty_rect(number):
+    layers = [ColorLayer(resize=(1500, 1000), color=(30, 30, 30))]
+    for i in range(10):
+        # mostly transparent outlines and opaque cards
+        layers.append(RectangleLayer(size=(800, 600), radius=40, line_width=2, color=(200, 200, 200, 200),
+                                     pos=(i * 50, i * 30)))
+        layers.append(RectangleLayer(size=(300, 80), color=(0, 100, 200), pos=(i * 100, i * 60)))
+    stack = ImageStack(layers)
+    stack._init()
+    image_creator = ImageCreator()
+    report('dirty_rect 20 layers 1500x1000', lambda: call_async(stack.create(image_creator)), number)
+
+
+@benchmark
+def culling(number):
+    # a long timeline of cards of which only a few are inside the canvas
+    layers = [ColorLayer(resize=(800, 600), color=(30, 30, 30))]
+    for i in range(200):
+        layers.append(RectangleLayer(size=(180, 120), radius=12, color=(0, 100, 200), pos=(i * 200 - 2000, 100)))
+        layers.append(TextLayer(text='', color=(0, 0, 0, 0), pos=(i * 200 - 2000, 100)))
+    stack = ImageStack(layers)
+    stack._init()
+    image_creator = ImageCreator()
+    report('culling 400 layers, 8 visible', lambda: call_async(stack.create(image_creator)), number)
+
+
+@benchmark
+def tiled(number):
+    # a poster sized canvas, encoded in one piece or streamed band by band
+    layers = [ColorLayer(resize=(6000, 4000), color=LinearGradientColor((30, 30, 30), (90, 60, 30)))]
+    for i in range(40):
+        layers.append(RectangleLayer(size=(900, 300), radius=40, color=(0, 100, 200, 200),
+                                     pos=(i * 130, i * 90)))
+    stack = ImageStack(layers)
+    stack._init()
+    image_creator = ImageCreator()
+    with tempfile.TemporaryDirectory() as path:
+        file_name = os.path.join(path, 'tiled.png')
+
+        def create_tiled():
+            with open(file_name, 'wb') as file:
+                call_async(stack.create_tiled(image_creator, file, tile_size=512))
+
+        report('create_bytes 6000x4000', lambda: call_async(stack.create_bytes(image_creator, None)), number)
+        report('create_tiled 6000x4000', create_tiled, number)
+        report_peak('create_bytes 6000x4000', lambda: call_async(stack.create_bytes(image_creator, None)))
+        report_peak('create_tiled 6000x4000', create_tiled)
+
+
+@benchmark
+def scaled_render(number):
+    # a large template requested as a thumbnail
+    layers = [ColorLayer(resize=(2000, 1500), color=LinearGradientColor((30, 30, 30), (90, 60, 30)))]
+    for i in range(10):
+        layers.append(RectangleLayer(size=(900, 500), radius=50, color=(0, 100, 200, 200), pos=(i * 100, i * 90)))
+    stack = ImageStack(layers)
+    stack._init()
+    for scaled in [False, True]:
+        image_creator = ImageCreator(scaled_render=scaled)
+        report('scaled_render={}, 2000x1500 -> 256'.format(scaled),
+               lambda: call_async(stack.create(image_creator, (256, 256))), number)
+
+
+@benchmark
+def buffer_pool(number):
+    layers = [ColorLayer(resize=(1920, 1080), color=(30, 30, 30))]
+    for i in range(10):
+        layers.append(RectangleLayer(size=(800, 400), radius=30, color=(0, 100, 200, 200), pos=(i * 100, i * 60)))
+    stack = ImageStack(layers)
+    stack._init()
+    for pool_bytes in [0, 64 * 1024 * 1024]:
+        image_creator = ImageCreator(buffer_pool_idle_bytes=pool_bytes)
+        report('buffer pool {} MB, 11 layers 1920x1080'.format(pool_bytes >> 20),
+               lambda: image_creator.buffers.release(call_async(stack.render(image_creator))), number)
+        if pool_bytes > 0:
+            print('peak pool bytes {:.1f} MB'.format(image_creator.buffers.stats()['peak_bytes'] / 1024 ** 2))
+
+
+@benchmark
+def colors(number):
+    color = SingleColor((255, 128, 0))
+    gradient = LinearGradientColor((255, 0, 0), (0, 0, 255, 128))
+    report('SingleColor((255, 128, 0)) x1000', lambda: [SingleColor((255, 128, 0)) for _ in range(1000)], number)
+    report('SingleColor.lightened(0.8) x1000', lambda: [color.lightened(0.8) for _ in range(1000)], number)
+    report('SingleColor.alpha(128) x1000', lambda: [color.alpha(128) for _ in range(1000)], number)
+    report('LinearGradientColor.color_mix x1000', lambda: [gradient.color_mix(0.5) for _ in range(1000)], number)
+
+    # a template of 200 themed rows, resolved per request
+    layers = [ColorLayer(resize=(800, 2000), color=(30, 30, 30))]
+    for i in range(200):
+        layers.append(RectangleLayer(size=(780, 8), pos=(10, i * 10), color=SingleColorVariable('accent').lightened(0.9)))
+        layers.append(RectangleLayer(size=(20, 8), pos=(10, i * 10), color=SingleColor((255, 255, 255, 200))))
+    resolve = ImageStackResolve(ImageStack(layers))
+    report('resolve 401 colored layers', lambda: resolve({'accent': (200, 120, 40)}), number)
+
+
+@benchmark
+def emoji(number):
+    emojis = ['🎈', '❤️', '🇩🇪', '👨\u200d👩\u200d👧', 'a', '✓'] * 100
+    text = 'Party 🎈 with 👨\u200d👩\u200d👧 in 🇩🇪, thumbs 👍🏽 and plain text around it. ' * 20
+    emoji_trie()
+    report('is_emoji x600', lambda: [is_emoji(e) for e in emojis], number)
+    report('split_graphemes 1.4k chars', lambda: split_graphemes(text), number)
+    report('segment_emojis 1.4k chars', lambda: segment_emojis(text), number)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark imagestack rendering')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all if omitted')
+    parser.add_argument('-n', '--number', type=int, default=20)
+    args = parser.parse_args()
+
+    for name in args.names or BENCHMARKS.keys():
+        BENCHMARKS[name](args.number)
@@ -1,8 +1,15 @@
 from .helpers import *
+from .emoji import *
+from .mapped_store import *
 from .colors import *
+from .shapes import *
 from .variables import *
+from .cache import *
 from .loaders import *
+from .fetcher import *
+from .emoji_index import *
 from .layers import *
+from .emoji_atlas import *
 from .animated_layers import *
 from .imagestack import *
 from .imageresolve import *
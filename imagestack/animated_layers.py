@@ -27,6 +27,8 @@ class RotationLayer(VariableKwargManager, AnimatedCreateable):
         self.rotate._init()
         self.img = visitor.visit_ImageStack(self.rotate)
         self.img = cv2.cvtColor(self.img, cv2.COLOR_RGBA2BGRA)
+        if visitor.premultiplied:
+            self.bg_color = premultiplied_color(self.bg_color)
 
     def create_progress(self, i):
         angle = normalize_angle(self.rotation_func(i))
@@ -0,0 +1,454 @@
+import cv2
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from .helpers import validated_image, read_image, jpeg_size, decode_reduction, resize_image, resize_interpolation, build_mipmaps
+
+
+class LRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key][0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+            self.items[key] = (value, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.items.popitem(last=False)
+                self.bytes -= evicted_bytes
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            if key in self.items:
+                value, nbytes = self.items.pop(key)
+                self.bytes -= nbytes
+                return value
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+# reusable render buffers in size classes, so large canvases and layers are not allocated and page faulted per render
+#
+# arrays handed out by get are views of a pooled buffer, release returns the buffer of any of its views.
+# borrowed buffers are only weakly referenced, one that is never released is simply garbage collected.
+# max_idle_bytes only caps the idle buffers kept between renders, anything beyond is left to the garbage collector.
+# borrowed buffers are not limited, a render still allocates whatever it needs and peak_bytes reports it.
+class BufferPool:
+    def __init__(self, max_idle_bytes, min_bytes=64 * 1024):
+        self.max_idle_bytes = max_idle_bytes
+        self.min_bytes = min_bytes
+        self.idle = {}
+        self.borrowed = weakref.WeakValueDictionary()
+        self.idle_bytes = 0
+        self.peak_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def size_class(nbytes):
+        # eight classes per power of two, at most a quarter of a buffer is unused
+        shift = max(0, nbytes.bit_length() - 3)
+        return -(-nbytes >> shift) << shift
+
+    def get(self, shape, dtype=np.uint8):
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if nbytes < self.min_bytes or self.max_idle_bytes <= 0:
+            return np.empty(shape, dtype=dtype)
+
+        size = self.size_class(nbytes)
+        with self.lock:
+            buffers = self.idle.get(size)
+            if buffers:
+                buffer = buffers.pop()
+                self.idle_bytes -= size
+                self.hits += 1
+            else:
+                buffer = None
+                self.misses += 1
+        if buffer is None:
+            buffer = np.empty(size, dtype=np.uint8)
+
+        with self.lock:
+            self.borrowed[id(buffer)] = buffer
+            self.peak_bytes = max(self.peak_bytes, self.borrowed_bytes() + self.idle_bytes)
+        return buffer[:nbytes].view(dtype).reshape(shape)
+
+    def borrowed_bytes(self):
+        return sum(buffer.nbytes for buffer in self.borrowed.values())
+
+    def take(self, img):
+        # the buffer of a pooled array, removed from the borrowed ones
+        buffer = img.base if img is not None else None
+        if buffer is None:
+            return None
+        with self.lock:
+            if self.borrowed.pop(id(buffer), None) is None:
+                return None
+        return buffer
+
+    def owns(self, img):
+        return img is not None and img.base is not None and id(img.base) in self.borrowed
+
+    def release(self, img):
+        buffer = self.take(img)
+        if buffer is None:
+            return
+        with self.lock:
+            if self.idle_bytes + buffer.nbytes <= self.max_idle_bytes:
+                self.idle.setdefault(buffer.nbytes, []).append(buffer)
+                self.idle_bytes += buffer.nbytes
+
+    # arrays handed to a caller or a cache are never returned to the pool
+    def forget(self, img):
+        self.take(img)
+
+    def clear(self):
+        with self.lock:
+            self.idle.clear()
+            self.idle_bytes = 0
+
+    def stats(self):
+        return {
+            'idle_bytes': self.idle_bytes,
+            'borrowed_bytes': self.borrowed_bytes(),
+            'peak_bytes': self.peak_bytes,
+            'max_idle_bytes': self.max_idle_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.deduplicated = 0
+
+    # concurrent calls with the same key wait for the first one instead of repeating the work
+    def run(self, key, func):
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[key] = future
+            else:
+                self.deduplicated += 1
+
+        if owner:
+            try:
+                future.set_result(func())
+            except Exception as err:
+                future.set_exception(err)
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+        return future.result()
+
+
+class DiskCache:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest() + ext)
+
+    def get(self, key):
+        try:
+            with open(self._file(key, '.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(self._file(key, '.bin'), 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None, None
+        return content, meta
+
+    def _write(self, file, data, mode):
+        tmp = '{}.{}.tmp'.format(file, threading.get_ident())
+        with open(tmp, mode) as f:
+            f.write(data)
+        os.replace(tmp, file)
+
+    def put(self, key, content, meta):
+        if content is not None:
+            self._write(self._file(key, '.bin'), content, 'wb')
+        self._write(self._file(key, '.json'), json.dumps(meta), 'w')
+
+
+class RemoteImageCache:
+    def __init__(self, fetcher, max_bytes=64 * 1024 * 1024, path=None, ttl=3600):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.memory = LRUCache(max_bytes)
+        # source sizes of the last 4096 urls, none for anything but jpeg
+        self.jpeg_sizes = LRUCache(4096)
+        self.disk = None
+        if path is not None:
+            self.disk = DiskCache(path)
+
+        self.lock = threading.Lock()
+        self.single_flight = SingleFlight()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+        self.bytes_saved = 0
+
+    def _count(self, name, value=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def get(self, url, target_size=None):
+        # decoded images are keyed by the jpeg reduction, unreduced ones share the plain url entry
+        if target_size is None or url in self.jpeg_sizes:
+            factor = decode_reduction(self.jpeg_sizes.get(url), target_size)
+            entry = self.memory.get(url if factor == 1 else (url, factor))
+            if entry is not None and time.time() - entry[2] < self.ttl:
+                self._count('memory_hits')
+                self._count('bytes_saved', entry[1])
+                return entry[0]
+
+        return self.single_flight.run((url, target_size), lambda: self._load_into_memory(url, target_size))
+
+    def _load_into_memory(self, url, target_size):
+        content, fetched = self.single_flight.run(('content', url), lambda: self._load(url))
+        size = jpeg_size(content)
+        self.jpeg_sizes.put(url, size, 1)
+        factor = decode_reduction(size, target_size)
+        key = url if factor == 1 else (url, factor)
+        entry = self.memory.get(key)
+        if entry is not None and entry[2] >= fetched:
+            return entry[0]
+
+        img = self.decode(content, factor)
+        if img is not None:
+            self.memory.put(key, (img, len(content), fetched), img.nbytes)
+        return img
+
+    def _load(self, url):
+        content, meta = None, None
+        if self.disk is not None:
+            content, meta = self.disk.get(url)
+
+        now = time.time()
+        if content is not None:
+            if now - meta['fetched'] < self.ttl:
+                self._count('disk_hits')
+                self._count('bytes_saved', len(content))
+                return content, meta['fetched']
+
+            headers = {}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            if len(headers) > 0:
+                r = self.fetcher.fetch(url, headers=headers)
+                if r.status == 304:
+                    self._count('revalidated')
+                    self._count('bytes_saved', len(content))
+                    meta['fetched'] = now
+                    self.disk.put(url, None, meta)
+                    return content, now
+            else:
+                r = self.fetcher.fetch(url)
+        else:
+            r = self.fetcher.fetch(url)
+
+        self._count('downloads')
+        if self.disk is not None:
+            self.disk.put(url, r.content, {
+                'url': url,
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'fetched': now,
+            })
+        return r.content, now
+
+    @staticmethod
+    def decode(content, factor=1):
+        img = read_image(content, factor=factor)
+        if img is not None:
+            img.flags.writeable = False
+        return img
+
+    def stats(self):
+        requests = self.memory_hits + self.disk_hits + self.revalidated + self.downloads
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'revalidated': self.revalidated,
+            'downloads': self.downloads,
+            'deduplicated': self.single_flight.deduplicated,
+            'hit_rate': (requests - self.downloads) / requests if requests > 0 else 0.0,
+            'bytes_saved': self.bytes_saved,
+            'memory': self.memory.stats(),
+        }
+
+
+class FileImageCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.memory = LRUCache(max_bytes)
+        # source sizes of the last 4096 files, none for anything but jpeg
+        self.jpeg_sizes = LRUCache(4096)
+        self.single_flight = SingleFlight()
+
+    @staticmethod
+    def key(file):
+        stat = os.stat(file)
+        return os.path.abspath(file), stat.st_mtime_ns, stat.st_size
+
+    def get(self, file, key=None, target_size=None):
+        if key is None:
+            key = self.key(file)
+        # decoded images are keyed by the jpeg reduction, unreduced ones share the plain key
+        factor = 1
+        if target_size is not None:
+            if key not in self.jpeg_sizes:
+                self.jpeg_sizes.put(key, jpeg_size(file), 1)
+            factor = decode_reduction(self.jpeg_sizes.get(key), target_size)
+            if factor > 1:
+                key = key + (factor,)
+
+        img = self.memory.get(key)
+        if img is None:
+            img = self.single_flight.run(key, lambda: self._load(key, file, factor))
+        return img
+
+    def _load(self, key, file, factor):
+        img = read_image(file, factor=factor)
+        if img is None:
+            raise Exception('"{}" could not be read'.format(file))
+        img = validated_image(img)
+        img.flags.writeable = False
+        self.memory.put(key, img, img.nbytes)
+        return img
+
+    def stats(self):
+        return {
+            'deduplicated': self.single_flight.deduplicated,
+            'memory': self.memory.stats(),
+        }
+
+
+class ResizeCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, mipmap_factor=2):
+        self.memory = LRUCache(max_bytes)
+        self.single_flight = SingleFlight()
+        self.mipmap_factor = mipmap_factor
+
+    def _source(self, img, key):
+        if key is not None:
+            return key
+        return id(img)
+
+    def _cached(self, k, img, key):
+        entry = self.memory.get(k)
+        if entry is None:
+            return None
+        value, source = entry
+        # without an explicit key the source is identified by the array itself, ids can be reused
+        if key is None and source() is not img:
+            return None
+        return value
+
+    def _put(self, k, img, key, value, nbytes):
+        source = None
+        if key is None:
+            source = weakref.ref(img)
+        self.memory.put(k, (value, source), nbytes)
+        return value
+
+    def mipmaps(self, img, key=None):
+        k = ('mipmaps', self._source(img, key))
+        levels = self._cached(k, img, key)
+        if levels is None:
+            levels = self.single_flight.run(k, lambda: self._build_mipmaps(k, img, key))
+        # only the smaller levels are cached, the source stays owned by whoever passed it in
+        return [img] + levels
+
+    def _build_mipmaps(self, k, img, key):
+        levels = build_mipmaps(img)[1:]
+        for level in levels:
+            level.flags.writeable = False
+        return self._put(k, img, key, levels, sum(level.nbytes for level in levels))
+
+    def get(self, img, size, interpolation=None, key=None):
+        size = tuple(size)
+        if interpolation is None:
+            interpolation = resize_interpolation(img.shape, size)
+
+        # only images shared by a cache (read only) or with an explicit key are worth remembering
+        if key is None and img.flags.writeable:
+            return resize_image(img, size, interpolation)
+
+        k = (self._source(img, key), size, interpolation)
+        resized = self._cached(k, img, key)
+        if resized is None:
+            resized = self.single_flight.run(k, lambda: self._resize(k, img, size, interpolation, key))
+        return resized
+
+    def _resize(self, k, img, size, interpolation, key):
+        mipmaps = None
+        if img.shape[1] >= size[0] * self.mipmap_factor and img.shape[0] >= size[1] * self.mipmap_factor:
+            mipmaps = self.mipmaps(img, key)
+        resized = resize_image(img, size, interpolation, mipmaps)
+        resized.flags.writeable = False
+        return self._put(k, img, key, resized, resized.nbytes)
+
+    def stats(self):
+        return {
+            'deduplicated': self.single_flight.deduplicated,
+            'memory': self.memory.stats(),
+        }
@@ -1,4 +1,24 @@
 import numpy as np
+from functools import lru_cache
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+
+@lru_cache(maxsize=256)
+def linear_gradient(color1, color2, length):
+    mix = np.linspace(0, 1, length, dtype=np.float32)[:, np.newaxis]
+    gradient = ((1 - mix) * np.array(color1, dtype=np.float32) + mix * np.array(color2, dtype=np.float32))
+    gradient = gradient.astype(np.uint8)
+    gradient.flags.writeable = False
+    return gradient
+
+
+def scale_alpha(mask, alpha):
+    # floor(mask * alpha / 255) in integer math, exact for 8 bit inputs
+    x = np.multiply(mask, np.asarray(alpha, dtype=np.uint16), dtype=np.uint16)
+    x += x >> 8
+    x += 1
+    x >>= 8
+    return x
 
 
 class ColorInterface:
@@ -11,27 +31,147 @@ class ColorInterface:
     def create(self, size):
         raise Exception('Raw usage of ColorInterface forbidden!')
 
+    # read only view that broadcasts to (size[0], size[1], 4) without materializing it
+    def create_broadcast(self, size):
+        return self.create(size)
+
+    # colors a single channel coverage mask into a bgra image in one pass
+    def tint(self, mask, out=None):
+        color = np.ascontiguousarray(self.create_broadcast(mask.shape))
+        img = out
+        if img is None:
+            img = np.empty((mask.shape[0], mask.shape[1], 4), dtype=np.uint8)
+        if mask.strides == (0, 0):
+            # uniform coverage is scaled once and broadcast
+            mask = mask[:1, :1]
+        # writing whole pixels as uint32 is much faster than a strided write of three channels
+        img.view(np.uint32)[..., 0] = color.view(np.uint32)[..., 0]
+        alpha = color[..., 3]
+        if alpha.size == 1 and alpha.flat[0] == 255:
+            img[..., 3] = mask
+        else:
+            img[..., 3] = scale_alpha(mask, alpha)
+        return img
+
+
+# immutable bgra color, the channels are kept as given after clamping and cached as 8 bit values for drawing.
+# arithmetic and ufuncs work like on the ndarray it used to be, results of the color's shape are colors again
+class SingleColor(NDArrayOperatorsMixin, ColorInterface):
+    __slots__ = ('values', 'bgra', 'pixel')
+    # colors given as plain ints are shared, templates use the same few colors over and over
+    interned = {}
+    max_interned = 4096
 
-class SingleColor(ColorInterface, np.ndarray):
     def __new__(cls, color):
-        color = [max(0, min(255, x)) for x in color]
-        if len(color) == 0:
-            color = (0, 0, 0, 0)
-        elif len(color) == 1:
-            color = (color[0], color[0], color[0], 255)
-        elif len(color) == 2:
-            color = (color[0], color[0], color[0], color[1])
-        elif len(color) == 3:
-            color = (color[2], color[1], color[0], 255)
-        elif len(color) >= 4:
-            color = (color[2], color[1], color[0], color[3])
-        return np.array(color).view(cls)
+        color = tuple(color)
+        interned = all(type(x) is int for x in color)
+        if interned:
+            instance = cls.interned.get(color)
+            if instance is not None:
+                return instance
+
+        values = color
+        if len(values) == 0:
+            values = (0, 0, 0, 0)
+        elif len(values) == 1:
+            values = (values[0], values[0], values[0], 255)
+        elif len(values) == 2:
+            values = (values[0], values[0], values[0], values[1])
+        elif len(values) == 3:
+            values = (values[2], values[1], values[0], 255)
+        elif len(values) >= 4:
+            values = (values[2], values[1], values[0], values[3])
+
+        instance = cls.from_bgra(values)
+        if interned and len(cls.interned) < cls.max_interned:
+            cls.interned[color] = instance
+        return instance
+
+    @classmethod
+    def from_bgra(cls, values):
+        kinds = set(map(type, values))
+        if kinds != {int} or min(values) < 0 or max(values) > 255:
+            # the clamp also turns floats at the bounds into ints
+            values = [max(0, min(255, x)) for x in values]
+            kinds = set(map(type, values))
+
+        # channels share one type like the numpy array they used to be
+        if kinds == {int}:
+            values = bgra = tuple(values)
+        elif all(issubclass(kind, (int, np.integer)) for kind in kinds):
+            values = bgra = tuple(map(int, values))
+        else:
+            values = tuple(map(float, values))
+            bgra = tuple(map(int, values))
+
+        instance = object.__new__(cls)
+        object.__setattr__(instance, 'values', values)
+        object.__setattr__(instance, 'bgra', bgra)
+        object.__setattr__(instance, 'pixel', None)
+        return instance
+
+    def __setattr__(self, key, value):
+        raise AttributeError('SingleColor is immutable')
+
+    def __reduce__(self):
+        return SingleColor.from_bgra, (self.values,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __eq__(self, other):
+        if isinstance(other, SingleColor):
+            return self.values == other.values
+        if isinstance(other, (tuple, list)):
+            return self.values == tuple(other)
+        # arrays compare elementwise through __array_ufunc__
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if isinstance(result, bool):
+            return not result
+        return np.logical_not(result)
+
+    def __hash__(self):
+        return hash(self.values)
+
+    def __repr__(self):
+        return 'SingleColor.from_bgra({})'.format(self.values)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.values, dtype=dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if any(isinstance(x, SingleColor) for x in kwargs.get('out', ())):
+            raise TypeError('SingleColor is immutable')
+        inputs = [np.asarray(x) if isinstance(x, SingleColor) else x for x in inputs]
+        result = getattr(ufunc, method)(*inputs, **kwargs)
+        if isinstance(result, np.ndarray) and result.shape == self.shape and result.dtype.kind in 'iuf':
+            return SingleColor.from_bgra(tuple(result.tolist()))
+        return result
+
+    @property
+    def shape(self):
+        return len(self.values),
 
     def get(self):
         return self
 
     def lightened(self, factor):
-        return SingleColor([self[2] * factor, self[1] * factor, self[0] * factor, self[3]])
+        return SingleColor.from_bgra((self[0] * factor, self[1] * factor, self[2] * factor, self[3]))
 
     def darkened(self, factor):
         return self.lightened(1 - factor)
@@ -43,7 +183,14 @@ class SingleColor(ColorInterface, np.ndarray):
         return SingleColor([self[2], self[1], self[0], self[3]])
 
     def create(self, size):
-        return np.full((size[0], size[1], self.shape[0]), self, dtype=np.uint8)
+        return np.full((size[0], size[1], len(self.bgra)), self.bgra, dtype=np.uint8)
+
+    def create_broadcast(self, size):
+        if self.pixel is None:
+            pixel = np.array(self.bgra, dtype=np.uint8).reshape(1, 1, -1)
+            pixel.flags.writeable = False
+            object.__setattr__(self, 'pixel', pixel)
+        return self.pixel
 
     def svg_color_definition(self):
         return '<linearGradient id="color"><stop stop-color="{}"/></linearGradient>'.format(self.html_color())
@@ -61,6 +208,17 @@ class SingleColor(ColorInterface, np.ndarray):
         return self[3] == 0
 
 
+# the SingleColor a color or color variable resolves to, plain arrays are bgra like the ndarray colors were
+def resolved_color(color):
+    if not isinstance(color, np.ndarray):
+        color = color.get()
+    if isinstance(color, SingleColor):
+        return color
+    if isinstance(color, (tuple, list)):
+        return SingleColor(color)
+    return SingleColor.from_bgra(tuple(np.asarray(color).tolist()))
+
+
 class LinearGradientColor(ColorInterface):
     def __init__(self, color1, color2, axis=0):
         self.color1 = self.validated(color1)
@@ -68,20 +226,19 @@ class LinearGradientColor(ColorInterface):
         self.direction_axis = axis
 
     def color_mix(self, mix):
-        return (1 - mix) * self.color1.get() + mix * self.color2.get()
+        return (1 - mix) * np.asarray(resolved_color(self.color1)) + mix * np.asarray(resolved_color(self.color2))
 
-    def create(self, size):
+    def create_broadcast(self, size):
+        color1 = resolved_color(self.color1).bgra
+        color2 = resolved_color(self.color2).bgra
         if self.direction_axis == 0:
-            size = (size[1], size[0])
+            return linear_gradient(color1, color2, size[0])[:, np.newaxis]
+        return linear_gradient(color1, color2, size[1])[np.newaxis]
 
-        lin = np.linspace(0, 1, size[1], dtype=np.float16)
-        color_gradient = np.array(list(map(self.color_mix, lin)), dtype=np.uint8)
-        color_gradient = np.repeat(color_gradient[:, np.newaxis], size[0], axis=1)
-
-        if self.direction_axis == 1:
-            color_gradient = color_gradient.swapaxes(0, 1)
-
-        return color_gradient
+    def create(self, size):
+        if self.direction_axis == 0:
+            return np.repeat(self.create_broadcast(size), size[1], axis=1)
+        return np.repeat(self.create_broadcast(size), size[0], axis=0)
 
     def svg_color_definition_with_id(self, color_id):
         gradient_transform = ''
@@ -120,4 +277,4 @@ class LinearGradientColor(ColorInterface):
         return 'background-image:{};'.format(self.html_color())
 
     def is_fully_transparent(self):
-        return self.color1.is_fully_transparent() and self.color1.is_fully_transparent()
+        return resolved_color(self.color1).is_fully_transparent() and resolved_color(self.color2).is_fully_transparent()
@@ -0,0 +1,133 @@
+import os
+import unicodedata
+from functools import lru_cache
+
+EMOJI_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'emoji-sequences.txt')
+
+ZWJ = '\u200d'
+QUALIFIED = 'qualified'
+UNQUALIFIED = 'unqualified'
+
+
+# code point trie of every emoji sequence, a lookup walks the text once
+class EmojiTrie:
+    # the end of a sequence is stored under a key no character can have
+    end_key = ''
+
+    def __init__(self, sequences=()):
+        self.root = {}
+        self.size = 0
+        for sequence, status in sequences:
+            self.add(sequence, status)
+
+    @classmethod
+    def load(cls, file=EMOJI_DATA):
+        def sequences():
+            with open(file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if len(line) == 0 or line.startswith('#'):
+                        continue
+                    points = line.split()
+                    status = QUALIFIED
+                    if points[-1] == 'u':
+                        points, status = points[:-1], UNQUALIFIED
+                    yield ''.join(chr(int(x, 16)) for x in points), status
+        return cls(sequences())
+
+    def add(self, sequence, status=QUALIFIED):
+        node = self.root
+        for c in sequence:
+            node = node.setdefault(c, {})
+        if self.end_key not in node:
+            self.size += 1
+        node[self.end_key] = status
+
+    # end of the longest emoji starting at start, start itself if there is none
+    def match(self, text, start=0, qualified=False):
+        node = self.root
+        end = start
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                break
+            status = node.get(self.end_key)
+            if status is not None and (not qualified or status == QUALIFIED):
+                end = i + 1
+        return end
+
+    def __contains__(self, text):
+        return isinstance(text, str) and len(text) > 0 and self.match(text) == len(text)
+
+    def __len__(self):
+        return self.size
+
+
+@lru_cache(maxsize=1)
+def emoji_trie():
+    return EmojiTrie.load()
+
+
+def is_emoji(emoji):
+    return emoji in emoji_trie()
+
+
+def match_emoji(text, start=0, qualified=False):
+    return emoji_trie().match(text, start, qualified)
+
+
+def _is_regional_indicator(c):
+    return '\U0001F1E6' <= c <= '\U0001F1FF'
+
+
+def _is_extend(c):
+    # marks, variation selectors, skin tones and tags never start a grapheme
+    return '\ufe00' <= c <= '\ufe0f' or '\U0001F3FB' <= c <= '\U0001F3FF' or '\U000E0020' <= c <= '\U000E007F' \
+        or unicodedata.category(c) in ('Mn', 'Me', 'Mc')
+
+
+# user perceived characters: emoji sequences, flags, crlf and characters with their combining marks.
+# an approximation of the extended grapheme clusters of UAX #29 without hangul syllables and prepend characters
+def split_graphemes(text):
+    trie = emoji_trie()
+    graphemes = []
+    start = 0
+    while start < len(text):
+        end = trie.match(text, start)
+        if end == start:
+            end = start + 1
+            if text[start] == '\r' and text[end:end + 1] == '\n':
+                end += 1
+            elif _is_regional_indicator(text[start]) and end < len(text) and _is_regional_indicator(text[end]):
+                end += 1
+        while end < len(text):
+            if _is_extend(text[end]):
+                end += 1
+            elif text[end] == ZWJ:
+                # a joiner attaches the following emoji as well, even in sequences unknown to the data
+                joined = trie.match(text, end + 1)
+                end = joined if joined > end + 1 else end + 1
+            else:
+                break
+        graphemes.append(text[start:end])
+        start = end
+    return graphemes
+
+
+# splits text into (run, is_emoji) pairs, runs of text are kept together and each emoji is its own run.
+# unqualified emoji like a bare "©" default to text presentation and stay text
+def segment_emojis(text):
+    trie = emoji_trie()
+    segments = []
+    run = []
+    for grapheme in split_graphemes(text):
+        if trie.match(grapheme, qualified=True) == 0:
+            run.append(grapheme)
+            continue
+        if len(run) > 0:
+            segments.append((''.join(run), False))
+            run = []
+        segments.append((grapheme, True))
+    if len(run) > 0:
+        segments.append((''.join(run), False))
+    return segments
@@ -0,0 +1,90 @@
+from . import *
+import argparse
+import cv2
+import numpy as np
+import os
+
+
+def build_emoji_atlas(emoji_path, file, sizes=(32, 64, 128)):
+    index = EmojiIndex(os.path.join(emoji_path, EmojiIndex.file_name))
+    if not index.load():
+        index.import_directory(emoji_path, save=False)
+
+    sizes = sorted(set(sizes))
+    emojis = {}
+    tiles = {size: [] for size in sizes}
+    for entry in index.emojis():
+        img = cv2.imread(index.file(entry['emoji']), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            continue
+        img = ImageLayer.validated(img)
+        native = img.shape[1::-1]
+        for size in sizes:
+            # the emoji keeps its aspect ratio in the top left corner of the tile
+            width, height = EmojiAtlas.fitted_size(native, size)
+            tile = np.zeros((size, size, 4), dtype=np.uint8)
+            tile[:height, :width] = cv2.resize(img, (width, height), interpolation=resize_interpolation(img.shape, (width, height)))
+            tiles[size].append(tile)
+        emojis[EmojiIndex.key(entry['emoji'])] = [len(emojis), native[0], native[1]]
+
+    arrays = {}
+    for size in sizes:
+        if len(emojis) == 0:
+            arrays[str(size)] = np.zeros((0, size, size, 4), dtype=np.uint8)
+        else:
+            arrays[str(size)] = np.stack(tiles[size])
+    write_mapped_store(file, arrays, meta={'sizes': sizes, 'emojis': emojis})
+    return len(emojis)
+
+
+class EmojiAtlas:
+    def __init__(self, file):
+        self.store = MappedStore(file)
+        self.sizes = self.store.meta['sizes']
+        self.emojis = self.store.meta['emojis']
+        self.tiles = {size: self.store.get(str(size)) for size in self.sizes}
+
+    def __contains__(self, emoji):
+        return EmojiIndex.key(emoji) in self.emojis
+
+    @staticmethod
+    def fitted_size(native, size):
+        scale = size / max(native)
+        return max(1, int(round(native[0] * scale))), max(1, int(round(native[1] * scale)))
+
+    # the smallest tile at least as big as the target (width, height)
+    def tile_size(self, target):
+        for size in self.sizes:
+            if size >= max(target):
+                return size
+        return self.sizes[-1]
+
+    # emojis without a resize are returned at the size of their source image
+    def get(self, emoji, resize=False, resize_cache=None):
+        entry = self.emojis.get(EmojiIndex.key(emoji))
+        if entry is None:
+            return None
+        slot, native = entry[0], tuple(entry[1:])
+        size = self.tile_size(native if resize is False else resize)
+        width, height = self.fitted_size(native, size)
+        tile = self.tiles[size][slot][:height, :width]
+        if resize is not False or tile.shape[1::-1] == native:
+            return tile
+        if resize_cache is None:
+            return resize_image(tile, native)
+        return resize_cache.get(tile, native, key=('atlas', slot, size))
+
+    # identifies the image get returns, for caching its resized variants
+    def key(self, emoji, resize=False):
+        entry = self.emojis[EmojiIndex.key(emoji)]
+        native = tuple(entry[1:])
+        return 'atlas', entry[0], self.tile_size(native if resize is False else resize), resize is False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack an emoji directory into a memory mapped atlas')
+    parser.add_argument('emoji_path')
+    parser.add_argument('file')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32, 64, 128])
+    args = parser.parse_args()
+    print('packed {} emojis'.format(build_emoji_atlas(args.emoji_path, args.file, args.sizes)))
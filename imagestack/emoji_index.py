@@ -0,0 +1,169 @@
+from . import *
+import json
+import os
+import shutil
+import tarfile
+import threading
+import zipfile
+
+
+class EmojiIndex:
+    file_name = 'emoji_index.json'
+    image_extensions = ('.png',)
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(emoji):
+        return '-'.join('{:x}'.format(ord(c)) for c in emoji)
+
+    @staticmethod
+    def emoji_from_file_name(name):
+        name = os.path.splitext(os.path.basename(name))[0]
+        if name.startswith('emoji_u'):
+            name = name[len('emoji_u'):]
+        # utf-8 hex as written by from_char, or code points like "1f1e9-1f1ea"
+        candidates = []
+        try:
+            candidates.append(to_char(name))
+        except ValueError:
+            pass
+        try:
+            candidates.append(''.join(chr(int(x, 16)) for x in name.replace('_', '-').split('-')))
+        except (ValueError, OverflowError):
+            pass
+        for emoji in candidates:
+            if is_emoji(emoji):
+                return emoji
+        return None
+
+    def directory(self):
+        if self.path is None:
+            return None
+        return os.path.dirname(os.path.abspath(self.path))
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            self.entries = json.load(f)
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps(self.entries)
+        tmp = '{}.{}.tmp'.format(self.path, threading.get_ident())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def _location(self, file):
+        file = os.path.abspath(file)
+        directory = self.directory()
+        if directory is not None and os.path.dirname(file) == directory:
+            return os.path.basename(file)
+        return file
+
+    def _set(self, emoji, **location):
+        with self.lock:
+            entry = dict(self.entries.get(self.key(emoji), {}))
+            entry['emoji'] = emoji
+            entry.update(location)
+            self.entries[self.key(emoji)] = entry
+
+    def add(self, emoji, file=None, url=None, save=True):
+        location = {}
+        if file is not None:
+            location['file'] = self._location(file)
+        if url is not None:
+            location['url'] = url
+        self._set(emoji, **location)
+        if save:
+            self.save()
+
+    # forgets the file of an emoji, its url is kept for downloads
+    def remove_file(self, emoji, save=True):
+        with self.lock:
+            entry = self.entries.get(self.key(emoji))
+            if entry is None or 'file' not in entry:
+                return
+            entry = {k: v for k, v in entry.items() if k != 'file'}
+            if 'url' in entry:
+                self.entries[self.key(emoji)] = entry
+            else:
+                del self.entries[self.key(emoji)]
+        if save:
+            self.save()
+
+    def lookup(self, emoji):
+        return self.entries.get(self.key(emoji))
+
+    def file(self, emoji):
+        entry = self.lookup(emoji)
+        if entry is None or 'file' not in entry:
+            return None
+        directory = self.directory()
+        if directory is None:
+            return entry['file']
+        return os.path.join(directory, entry['file'])
+
+    def url(self, emoji):
+        entry = self.lookup(emoji)
+        if entry is None:
+            return None
+        return entry.get('url')
+
+    def emojis(self):
+        return [entry for entry in self.entries.values() if 'file' in entry]
+
+    def import_directory(self, directory, save=True):
+        count = 0
+        for f in os.listdir(directory):
+            if not f.lower().endswith(self.image_extensions):
+                continue
+            emoji = self.emoji_from_file_name(f)
+            if emoji is not None:
+                self.add(emoji, file=os.path.join(directory, f), save=False)
+                count += 1
+        if save:
+            self.save()
+        return count
+
+    def import_archive(self, archive, target_directory=None, save=True):
+        if target_directory is None:
+            target_directory = self.directory()
+        if target_directory is None:
+            raise Exception('Importing an archive needs a target directory')
+        os.makedirs(target_directory, exist_ok=True)
+
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as z:
+                members = [(m.filename, lambda m=m: z.open(m)) for m in z.infolist() if not m.is_dir()]
+                count = self._import_members(members, target_directory)
+        else:
+            with tarfile.open(archive) as t:
+                members = [(m.name, lambda m=m: t.extractfile(m)) for m in t.getmembers() if m.isfile()]
+                count = self._import_members(members, target_directory)
+        if save:
+            self.save()
+        return count
+
+    def _import_members(self, members, target_directory):
+        count = 0
+        for name, open_member in members:
+            if not name.lower().endswith(self.image_extensions):
+                continue
+            emoji = self.emoji_from_file_name(name)
+            if emoji is None:
+                continue
+            file = os.path.join(target_directory, from_char(emoji) + '.png')
+            with open_member() as src, open(file, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            self.add(emoji, file=file, save=False)
+            count += 1
+        return count
@@ -0,0 +1,55 @@
+import requests
+from collections import namedtuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+FetchResult = namedtuple('FetchResult', ['status', 'content', 'headers'])
+
+
+class HttpFetcher:
+    def __init__(self,
+                 pool_size=10,
+                 timeout=(3.05, 10),
+                 max_bytes=10 * 1024 * 1024,
+                 retries=2,
+                 backoff_factor=0.3
+                 ):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'HEAD']))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, url, headers=None):
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as r:
+            r.raise_for_status()
+            if r.status_code == 304:
+                return FetchResult(r.status_code, b'', r.headers)
+
+            length = r.headers.get('Content-Length')
+            if length is not None and int(length) > self.max_bytes:
+                raise Exception('"{}" is bigger than {} bytes'.format(url, self.max_bytes))
+
+            content = bytearray()
+            for chunk in r.iter_content(64 * 1024):
+                content += chunk
+                if len(content) > self.max_bytes:
+                    raise Exception('"{}" is bigger than {} bytes'.format(url, self.max_bytes))
+            return FetchResult(r.status_code, bytes(content), r.headers)
+
+    def get(self, url, headers=None):
+        return self.fetch(url, headers=headers).content
+
+    def get_text(self, url, headers=None):
+        return self.get(url, headers=headers).decode('utf-8', errors='replace')
+
+    def close(self):
+        self.session.close()
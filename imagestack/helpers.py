@@ -1,15 +1,25 @@
 from . import *
+import asyncio
 import cv2
+import io
 from PIL import Image
 import numpy as np
 from math import ceil, sqrt, radians, sin, cos
-import re
 
 
 ALPHA_COLOR = (255, 255, 255, 255)
 LINE_TYPE = cv2.LINE_AA
 
 
+# runs the blocking jobs (key -> callable) concurrently, failed jobs map to their exception
+async def run_all(executor, jobs):
+    loop = asyncio.get_running_loop()
+    keys = list(jobs.keys())
+    results = await asyncio.gather(*[loop.run_in_executor(executor, jobs[key]) for key in keys],
+                                   return_exceptions=True)
+    return dict(zip(keys, results))
+
+
 def from_char(c):
     return c.encode('utf-8').hex()
 
@@ -72,30 +82,78 @@ def size_to_html(size, el, prefix='', relative=False):
         .format(prefix, width, prefix, height)
 
 
-def is_emoji(emoji):
-    if len(emoji) != 1:
-        return False
-    regex_pattern = re.compile("["
-                               u"\U0001F600-\U0001F64F"
-                               u"\U0001F300-\U0001F5FF"
-                               u"\U0001F680-\U0001F6FF"
-                               u"\U0001F1E0-\U0001F1FF"
-                               u"\U00002500-\U00002BEF"
-                               u"\U00002702-\U000027B0"
-                               u"\U00002702-\U000027B0"
-                               u"\U000024C2-\U0001F251"
-                               u"\U0001f926-\U0001f937"
-                               u"\U00010000-\U0010ffff"
-                               u"\u2640-\u2642"
-                               u"\u2600-\u2B55"
-                               u"\u200d"
-                               u"\u23cf"
-                               u"\u23e9"
-                               u"\u231a"
-                               u"\ufe0f"  # dingbats
-                               u"\u3030"
-                               "]+", re.UNICODE)
-    return bool(regex_pattern.search(emoji))
+def validated_image(img):
+    if len(img.shape) == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGBA)
+    elif img.shape[2] == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
+    return img
+
+
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def jpeg_size(source):
+    # only jpeg can be decoded at a reduced scale, it has no alpha channel to lose
+    try:
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as header:
+            if header.format == 'JPEG':
+                return header.size
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def decode_reduction(source_size, target_size):
+    if source_size is None or target_size is None:
+        return 1
+    for factor in (8, 4, 2):
+        if source_size[0] // factor >= target_size[0] and source_size[1] // factor >= target_size[1]:
+            return factor
+    return 1
+
+
+def read_image(source, target_size=None, factor=None):
+    # source is a file name or the encoded bytes
+    if factor is None:
+        factor = decode_reduction(jpeg_size(source) if target_size is not None else None, target_size)
+    flags = cv2.IMREAD_UNCHANGED
+    if factor > 1:
+        flags = REDUCED_DECODE_FLAGS[factor] | cv2.IMREAD_IGNORE_ORIENTATION
+    if isinstance(source, str):
+        return cv2.imread(source, flags)
+    return cv2.imdecode(np.frombuffer(source, np.uint8), flags)
+
+
+def resize_interpolation(src_shape, size):
+    if size[0] <= src_shape[1] and size[1] <= src_shape[0]:
+        return cv2.INTER_AREA
+    return cv2.INTER_LINEAR
+
+
+def build_mipmaps(img, min_size=8):
+    levels = [img]
+    while min(levels[-1].shape[:2]) >= min_size * 2:
+        h, w = levels[-1].shape[:2]
+        levels.append(cv2.resize(levels[-1], (w // 2, h // 2), interpolation=cv2.INTER_AREA))
+    return levels
+
+
+def resize_image(img, size, interpolation=None, mipmaps=None):
+    size = tuple(size)
+    if interpolation is None:
+        interpolation = resize_interpolation(img.shape, size)
+    if mipmaps is not None:
+        # start from the smallest level that is still at least as big as the target
+        for level in reversed(mipmaps):
+            if level.shape[1] >= size[0] and level.shape[0] >= size[1]:
+                img = level
+                break
+    return cv2.resize(img, size, interpolation=interpolation)
 
 
 def rotate_image(iimage, angle, bg_color=(0, 0, 0, 0), padding=False):
@@ -150,21 +208,15 @@ def invert_image(img):
     return 255 - img
 
 
-def overlay(background, foreground, x=0, y=0, max_size=(-1, -1), align_x='left', align_y='top'):
-    if background is None:
-        return foreground
-
-    if foreground is None:
-        return background
-
-    h, w = foreground.shape[0], foreground.shape[1]
+def overlay_region(background_shape, foreground_shape, x=0, y=0, max_size=(-1, -1), align_x='left', align_y='top'):
+    h, w = foreground_shape[0], foreground_shape[1]
 
     if align_y == 'bottom':
         n_h = h
         if max_size[1] >= 0:
             n_h = min(max_size[1], h)
         by_start = max(0, y - n_h)
-        by_end = min(y, background.shape[0])
+        by_end = min(y, background_shape[0])
         fy_start = h - n_h
         fy_end = by_end
     elif align_y == 'center':
@@ -174,7 +226,7 @@ def overlay(background, foreground, x=0, y=0, max_size=(-1, -1), align_x='left',
         hh_a = int(n_h * 0.5)
         hh_b = n_h - hh_a
         by_start = max(0, y - hh_a)
-        by_end = min(y + hh_b, background.shape[0])
+        by_end = min(y + hh_b, background_shape[0])
         fy_start = 0
         fy_end = by_end - by_start
     # Default alignment top
@@ -182,7 +234,7 @@ def overlay(background, foreground, x=0, y=0, max_size=(-1, -1), align_x='left',
         if max_size[1] >= 0:
             h = min(max_size[1], h)
         by_start = max(0, y)
-        by_end = min(y + h, background.shape[0])
+        by_end = min(y + h, background_shape[0])
         fy_start = 0
         fy_end = by_end - by_start
 
@@ -191,7 +243,7 @@ def overlay(background, foreground, x=0, y=0, max_size=(-1, -1), align_x='left',
         if max_size[0] >= 0:
             n_w = min(max_size[0], w)
         bx_start = max(0, x - n_w)
-        bx_end = min(x, background.shape[1])
+        bx_end = min(x, background_shape[1])
         fx_start = w - n_w
         fx_end = bx_end
 
@@ -202,7 +254,7 @@ def overlay(background, foreground, x=0, y=0, max_size=(-1, -1), align_x='left',
         hw_a = int(n_w * 0.5)
         hw_b = n_w - hw_a
         bx_start = max(0, x - hw_a)
-        bx_end = min(x + hw_b, background.shape[1])
+        bx_end = min(x + hw_b, background_shape[1])
         fx_start = 0
         fx_end = bx_end - bx_start
 
@@ -211,20 +263,94 @@ def overlay(background, foreground, x=0, y=0, max_size=(-1, -1), align_x='left',
         if max_size[0] >= 0:
             w = min(max_size[0], w)
         bx_start = max(0, x)
-        bx_end = min(x + w, background.shape[1])
+        bx_end = min(x + w, background_shape[1])
         fx_start = 0
         fx_end = bx_end - bx_start
 
     if by_end - by_start < 0 or bx_end - bx_start < 0:
+        return None
+
+    return (slice(by_start, by_end), slice(bx_start, bx_end)), (slice(fy_start, fy_end), slice(fx_start, fx_end))
+
+
+def _alpha_channels(img, alpha_channel):
+    # extracting the channel first is much faster than merging strided views
+    alpha = cv2.extractChannel(img, 3)
+    return cv2.merge([alpha, alpha, alpha, np.full_like(alpha, alpha_channel)])
+
+
+def premultiply(img, dst=None):
+    return cv2.multiply(img, _alpha_channels(img, 255), dst=dst, scale=1 / 255)
+
+
+def unpremultiply(img, dst=None):
+    # cv2.divide yields 0 where alpha is 0
+    return cv2.divide(img, _alpha_channels(img, 255), dst=dst, scale=255)
+
+
+def premultiplied_color(color):
+    color = tuple(color)
+    if len(color) < 4:
+        return color
+    return tuple(int(c * color[3] / 255 + 0.5) for c in color[:3]) + (color[3],)
+
+
+# source over of premultiplied images is a multiply-add of every channel, no division per pixel
+def overlay_premultiplied_matching(background, foreground):
+    inverse_alpha = cv2.bitwise_not(cv2.extractChannel(foreground, 3))
+    inverse_alpha = cv2.merge([inverse_alpha, inverse_alpha, inverse_alpha, inverse_alpha])
+    return cv2.add(foreground, cv2.multiply(background, inverse_alpha, scale=1 / 255))
+
+
+def overlay(background, foreground, x=0, y=0, max_size=(-1, -1), align_x='left', align_y='top', in_place=False,
+            premultiplied=False):
+    if background is None:
+        return foreground
+
+    if foreground is None:
         return background
 
-    background = background.copy()
+    region = overlay_region(background.shape, foreground.shape, x, y, max_size, align_x, align_y)
+    if region is None:
+        return background
+    b_region, f_region = region
 
-    background[
-        by_start:by_end,
-        bx_start:bx_end
-    ] = overlay_matching(background[by_start:by_end, bx_start:bx_end],
-                         foreground[fy_start:fy_end, fx_start:fx_end])
+    foreground = foreground[f_region]
+    box = content_box(foreground)
+    if box is None:
+        return background
+
+    if not in_place:
+        background = background.copy()
+
+    # only the pixels that can change are touched
+    box_x, box_y, box_w, box_h = box
+    foreground = foreground[box_y:box_y + box_h, box_x:box_x + box_w]
+    target = background[b_region][box_y:box_y + box_h, box_x:box_x + box_w]
+    if cv2.minMaxLoc(cv2.extractChannel(foreground, 3))[0] == 255:
+        target[...] = foreground
+    elif premultiplied:
+        target[...] = overlay_premultiplied_matching(target, foreground)
+    else:
+        target[...] = overlay_matching(target, foreground)
 
     return background
 
+
+# tight (x, y, w, h) box around the pixels with any coverage, None if the image is fully transparent
+def content_box(img):
+    if img.shape[0] == 0 or img.shape[1] == 0:
+        return None
+    box = cv2.boundingRect(cv2.extractChannel(img, 3))
+    if box[2] == 0 or box[3] == 0:
+        return None
+    return box
+
+
+def rectangle_shape(size, radius=0, line_width=-1):
+    diameter = radius * 2
+    thick_offset = max(0, line_width)
+    double_thickoff = max(1, thick_offset * 2)
+    mthick_offset = max(1, thick_offset)
+    return (max(1, diameter - mthick_offset, size[1] - mthick_offset) + double_thickoff,
+            max(1, diameter - mthick_offset, size[0] - mthick_offset) + double_thickoff)
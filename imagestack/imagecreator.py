@@ -1,15 +1,22 @@
 from . import *
+import cv2
 import os
 import asyncio
 import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-from . import to_char
+from . import from_char
 
 
 class AsyncEvent(asyncio.Event):
+    def __init__(self):
+        super().__init__()
+        # Event only binds its loop once it is awaited, which a fast worker thread can beat
+        self.loop = asyncio.get_running_loop()
+
     def set(self):
-        # TODO: _loop is not documented
-        self._loop.call_soon_threadsafe(super().set)
+        self.loop.call_soon_threadsafe(super().set)
 
 
 class ImageCreator:
@@ -20,15 +27,65 @@ class ImageCreator:
                  emoji_fallback='🆘',
                  download_emojis=False,
                  save_downloaded_emojis=False,
-                 download_emoji_provider='microsoft'
+                 download_emoji_provider='microsoft',
+                 fetcher=None,
+                 web_cache_bytes=64 * 1024 * 1024,
+                 web_cache_path=None,
+                 web_cache_ttl=3600,
+                 emoji_index=None,
+                 emoji_atlas=None,
+                 file_cache_bytes=64 * 1024 * 1024,
+                 lazy_memory=False,
+                 memory_cache_bytes=256 * 1024 * 1024,
+                 resize_cache_bytes=64 * 1024 * 1024,
+                 sprite_cache_bytes=32 * 1024 * 1024,
+                 mask_cache_bytes=32 * 1024 * 1024,
+                 buffer_pool_idle_bytes=64 * 1024 * 1024,
+                 io_workers=16,
+                 premultiplied=False,
+                 scaled_render=False
                  ):
         self.font_loader = FontLoader(fonts)
 
+        # a fetcher passed in may be shared, only the own one is closed
+        self.owns_fetcher = fetcher is None
+        if fetcher is None:
+            fetcher = HttpFetcher()
+        self.fetcher = fetcher
+        self.web_images = RemoteImageCache(fetcher, max_bytes=web_cache_bytes, path=web_cache_path, ttl=web_cache_ttl)
+        self.file_images = FileImageCache(max_bytes=file_cache_bytes)
+        self.resized_images = ResizeCache(max_bytes=resize_cache_bytes)
+        # rendered layers without external inputs, keyed by fingerprint
+        self.sprites = LRUCache(max_bytes=sprite_cache_bytes)
+        # coverage masks of rectangles and pie wheels, keyed by their geometry
+        self.masks = LRUCache(max_bytes=mask_cache_bytes)
+        # canvases and layer buffers, borrowed and returned by every render. only the idle ones are capped
+        self.buffers = BufferPool(max_idle_bytes=buffer_pool_idle_bytes)
+        self.io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='imagestack-io')
+        # composite with premultiplied alpha, images are only converted back to straight alpha when encoded
+        self.premultiplied = premultiplied
+        # stacks shrunk by max_size are rasterized at the output resolution instead of being downscaled
+        self.scaled_render = scaled_render
+
+        self.stats_lock = threading.Lock()
+        self.culled_layers = 0
+
         self.save_downloaded_emojis = save_downloaded_emojis
         if emoji_path is None:
             self.save_downloaded_emojis = False
         self.emoji_path = emoji_path
 
+        if emoji_index is None and emoji_path is not None:
+            emoji_index = os.path.join(emoji_path, EmojiIndex.file_name)
+        self.emoji_index = EmojiIndex(emoji_index)
+        if not self.emoji_index.load() and emoji_path is not None and os.path.isdir(emoji_path):
+            self.emoji_index.import_directory(emoji_path, save=False)
+            self.save_emoji_index()
+
+        self.emoji_atlas = None
+        if emoji_atlas is not None:
+            self.emoji_atlas = EmojiAtlas(emoji_atlas)
+
         self.emoji_fallback = emoji_fallback
 
         self.download_emojis = download_emojis
@@ -37,27 +94,94 @@ class ImageCreator:
         if load_memory is None:
             load_memory = []
 
-        self.image_memory = {}
+        self.image_memory = ImageMemory(max_bytes=memory_cache_bytes)
         for loader in load_memory:
-            loader.load_into(self.add_to_memory)
+            if lazy_memory:
+                loader.register_into(self.image_memory.register)
+            else:
+                loader.load_into(self.add_to_memory)
+
+    def close(self):
+        self.io_executor.shutdown(wait=False)
+        if self.owns_fetcher:
+            self.fetcher.close()
+
+    def count_culled(self):
+        with self.stats_lock:
+            self.culled_layers += 1
 
     def add_to_memory(self, name, img):
-        if name in self.image_memory:
-            raise Exception('image with same name was loaded before! Use a prefix')
-        self.image_memory[name] = img
+        self.image_memory.add(name, img)
+
+    def emoji_char(self, emoji):
+        if emoji is None:
+            return self.emoji_fallback
+        return emoji
+
+    # the index is only written where this creator is allowed to write emojis
+    def save_emoji_index(self):
+        if not self.save_downloaded_emojis:
+            return
+        try:
+            self.emoji_index.save()
+        except OSError as err:
+            warnings.warn('Emoji index could not be saved: {}'.format(err))
+
+    def emoji_file(self, emoji):
+        file = self.emoji_index.file(emoji)
+        if file is not None:
+            if os.path.exists(file):
+                return file
+            # deleted or renamed since it was indexed
+            self.emoji_index.remove_file(emoji, save=False)
+            self.save_emoji_index()
+        if self.emoji_path is None:
+            return None
+        # files dropped into emoji_path after the index was built
+        file = os.path.join(self.emoji_path, from_char(emoji) + '.png')
+        if os.path.exists(file):
+            self.emoji_index.add(emoji, file=file, save=False)
+            self.save_emoji_index()
+            return file
+        return None
+
+    def save_emoji(self, emoji, img):
+        file = os.path.join(self.emoji_path, from_char(emoji) + '.png')
+        cv2.imwrite(file, img)
+        self.emoji_index.add(emoji, file=file, save=False)
+        self.save_emoji_index()
+
+    def load_emoji(self, el):
+        emoji = self.emoji_char(el.emoji)
+        file = self.emoji_file(emoji)
+        if file is not None:
+            return self.file_images.get(file, target_size=el.target_size())
+        if not self.download_emojis:
+            return None
+        img_bytes = self.download_emoji(el)
+        if img_bytes is None:
+            return None
+        img = read_image(img_bytes)
+        if self.save_downloaded_emojis:
+            self.save_emoji(emoji, img)
+        return img
+
+    def download_emoji(self, el):
+        emoji = self.emoji_char(el.emoji)
+        url = self.emoji_index.url(emoji)
+        if url is None:
+            url = el.get_emoji_image_url(self.download_emoji_provider, self.fetcher)
+            if url is None:
+                warnings.warn('Emoji "{}" was not found on "{}"!'.format(el.emoji, el.base_emoji_url))
+                return None
+            self.emoji_index.add(emoji, url=url, save=False)
+            self.save_emoji_index()
+        return self.fetcher.get(url)
 
     def get_downloaded_emojis(self):
         if not self.save_downloaded_emojis:
             return []
-        emojis = []
-        for e in os.listdir(self.emoji_path):
-            try:
-                emoji = to_char(os.path.splitext(e)[0])
-                if is_emoji(emoji):
-                    emojis.append({'emoji': emoji, 'path': e})
-            except:
-                pass
-        return emojis
+        return [{'emoji': entry['emoji'], 'path': entry['file']} for entry in self.emoji_index.emojis()]
 
     async def create(self, stack, max_size=(-1, -1)):
         if stack is None:
@@ -1,6 +1,9 @@
 from . import *
 from .visitor_create import VisitorCreate
 from .visitor_html import VisitorHtml
+from .tiled_render import TiledRender
+from .visitor_scale import VisitorScale
+import copy
 import io
 import cv2
 import numpy as np
@@ -26,27 +29,84 @@ class ImageStack(Createable, VariableKwargManager):
             layer._init()
         super()._init_finished()
 
-    async def create(self, image_creator, max_size=None):
-        v = VisitorCreate(image_creator)
-        img = self.accept(v)
-
+    @staticmethod
+    def resize_factor(size, max_size):
         resize_factor = 1
         if max_size is not None:
-            if 0 < max_size[0] < img.shape[1]:
-                resize_factor = max_size[0] / img.shape[1]
-            if 0 < max_size[1] < img.shape[0]:
-                resize_factor = min(resize_factor, max_size[1] / img.shape[0])
-
+            if 0 < max_size[0] < size[0]:
+                resize_factor = max_size[0] / size[0]
+            if 0 < max_size[1] < size[1]:
+                resize_factor = min(resize_factor, max_size[1] / size[1])
+        return resize_factor
+
+    # (width, height) of the canvas if it is known before rendering, None otherwise
+    def canvas_size(self):
+        # color layers and resized images define the canvas size before rendering
+        size = getattr(self.layers[0], 'resize', False)
+        if size is False:
+            return None
+        return tuple(size)
+
+    # a copy of the stack with its geometry scaled down to max_size, None if the canvas size is not known upfront
+    def scaled(self, max_size):
+        size = self.canvas_size()
+        if size is None:
+            return None
+        factor = self.resize_factor(size, max_size)
+        if factor >= 1:
+            return None
+        scaler = VisitorScale(factor)
+        stack = copy.deepcopy(self)
+        stack.accept(scaler)
+        return stack, scaler
+
+    # the rendered image may be a buffer of image_creator.buffers
+    async def render(self, image_creator, max_size=None):
+        stack, scaler = self, None
+        if image_creator.scaled_render:
+            scaled = self.scaled(max_size)
+            if scaled is not None:
+                stack, scaler = scaled
+
+        v = VisitorCreate(image_creator, scaler)
+        await v.gather(stack, stack.canvas_size())
+        img = stack.accept(v)
+        buffers = image_creator.buffers
+
+        resize_factor = self.resize_factor(img.shape[1::-1], max_size)
         if resize_factor < 1:
-            img = cv2.resize(img, (int(img.shape[1] * resize_factor), int(img.shape[0] * resize_factor)))
+            size = (int(img.shape[1] * resize_factor), int(img.shape[0] * resize_factor))
+            resized = cv2.resize(img, size, dst=buffers.get((size[1], size[0], img.shape[2])))
+            buffers.release(img)
+            img = resized
+
+        if v.premultiplied:
+            # converted back to straight alpha only once, for the encoder
+            if buffers.owns(img):
+                return unpremultiply(img, img)
+            return unpremultiply(img, buffers.get(img.shape))
+        if not img.flags.writeable:
+            # a single layer stack returns a shared cached image
+            return img.copy()
+        return img
+
+    async def create(self, image_creator, max_size=None):
+        img = await self.render(image_creator, max_size)
+        # the caller owns the image, it is never returned to the pool
+        image_creator.buffers.forget(img)
         return img
 
     async def create_bytes(self, image_creator, max_size):
-        img = await self.create(image_creator, max_size)
+        img = await self.render(image_creator, max_size)
 
         is_success, buffer = cv2.imencode('.png', img)
+        image_creator.buffers.release(img)
         return io.BytesIO(buffer)
 
+    # streams the png of a very large canvas into file, only a band of tile_size rows is held in memory
+    async def create_tiled(self, image_creator, file, tile_size=512, workers=None, compression=3):
+        await TiledRender(self, image_creator, tile_size, workers).write(file, compression)
+
     def create_html(self, image_creator):
         v = VisitorHtml(image_creator)
         return v.visit_ImageStack(self)
@@ -70,6 +130,7 @@ class AnimatedImageStack(Createable, VariableKwargManager):
 
     async def create(self, image_creator):
         v = VisitorCreate(image_creator)
+        await v.gather(self)
         image_data = self.accept(v)
         return image_data
 
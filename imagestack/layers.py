@@ -45,10 +45,11 @@ class ColoredLayer(AlignLayer):
         if not issubclass(type(self.color), ColorInterface):
             self.color = SingleColor(self.color)
 
-    def colored(self, img):
-        color_overlay = self.color.create(img.shape)
-        color_overlay[..., 3] = img[..., 3] * (color_overlay[..., 3] / 255.0)
-        return color_overlay
+    def colored(self, img, out=None):
+        # shapes are drawn as coverage, either a single channel mask or the alpha of a bgra image
+        if len(img.shape) == 3:
+            img = img[..., 3]
+        return self.color.tint(img, out)
 
     def html_style(self):
         return super().html_style() + self.color.html_style_background()
@@ -82,17 +83,21 @@ class ImageLayer(AlignLayer):
         super()._init()
         self.resize = self.get_kwarg('resize', False)
 
-    def validated(self, img):
-        if len(img.shape) == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGBA)
-        elif img.shape[2] == 3:
-            img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
-        return img
+    @staticmethod
+    def validated(img):
+        return validated_image(img)
 
-    def resized(self, img):
+    def target_size(self):
         if self.resize is False:
+            return None
+        return tuple(self.resize)
+
+    def resized(self, img, resize_cache=None, key=None):
+        if self.resize is False or img.shape[1::-1] == tuple(self.resize):
             return img
-        return cv2.resize(img, self.resize)
+        if resize_cache is None:
+            return resize_image(img, self.resize)
+        return resize_cache.get(img, self.resize, key=key)
 
     def html_image(self, url):
         return '<img src="{}" style="width:{}px;height:{}px;" />'.format(url, self.resize[0], self.resize[1])
@@ -135,9 +140,12 @@ class EmojiLayer(ImageLayer):
         return 'font-family: Segoe UI Emoji, Segoe UI Symbol, Symbola, Quivira;font-size:{}px;'\
                    .format(max(0, self.resize[0], self.resize[1]) * 0.75) + self.html_position_style(self.resize)
 
-    def get_emoji_image_url(self, provider):
-        r = requests.get(self.base_emoji_url + self.emoji)
-        for x in r.text.split('data-src="')[1:]:
+    def get_emoji_image_url(self, provider, fetcher=None):
+        if fetcher is None:
+            text = requests.get(self.base_emoji_url + self.emoji).text
+        else:
+            text = fetcher.get_text(self.base_emoji_url + self.emoji)
+        for x in text.split('data-src="')[1:]:
             url = x.split('"')[0]
             if '/{}/'.format(provider) in url:
                 return url
@@ -257,6 +265,7 @@ class RectangleLayer(ColoredLayer):
         self.size = self.get_kwarg('size', (0, 0))
         self.radius = self.get_kwarg('radius', 0)
         self.line_width = self.get_kwarg('line_width', -1)
+        self.antialias = self.get_kwarg('antialias', False)
         super()._init_finished()
 
 
@@ -304,16 +313,35 @@ class ListLayer(AlignLayer):
         self.margin = self.get_kwarg('margin', 0)
         super()._init_finished()
 
-    def concat(self, img1, img2):
-        if img1 is None:
-            return img2
-        elif img2 is None:
-            return img1
-        if self.direction == 'x':
-            return cv2.hconcat([img1, img2])
-        return cv2.vconcat([img1, img2])
-
-    def concat_margin(self, img):
-        if self.direction == 'x':
-            return cv2.hconcat([img, np.zeros((img.shape[0], self.margin, img.shape[2]), dtype=np.uint8)])
-        return cv2.vconcat([img, np.zeros((self.margin, img.shape[1], img.shape[2]), dtype=np.uint8)])
+    # measures the rendered items and writes each of them into its slot of one preallocated image
+    def assemble(self, items, buffers=None):
+        axis = 1 if self.direction == 'x' else 0
+        offsets = []
+        length = 0
+        for i, item in enumerate(items):
+            offsets.append(length)
+            if item is not None:
+                length += item.shape[axis]
+            if i < len(items) - 1 and length > 0:
+                length += self.margin
+
+        rendered = [item for item in items if item is not None]
+        if len(rendered) == 0:
+            return None
+
+        shape = [0, 0, max(item.shape[2] for item in rendered)]
+        shape[axis] = length
+        shape[1 - axis] = max(item.shape[1 - axis] for item in rendered)
+        if buffers is None:
+            img = np.zeros(shape, dtype=np.uint8)
+        else:
+            img = buffers.get(tuple(shape))
+            img.fill(0)
+        for offset, item in zip(offsets, items):
+            if item is None:
+                continue
+            if axis == 1:
+                img[:item.shape[0], offset:offset + item.shape[1]] = item
+            else:
+                img[offset:offset + item.shape[0], :item.shape[1]] = item
+        return img
@@ -1,34 +1,168 @@
 import cv2
 import os
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from PIL import ImageFont
 
+from .cache import LRUCache, SingleFlight
+from .helpers import validated_image
+from .mapped_store import MappedStore, write_mapped_store
+
+
+def load_image_file(file):
+    img = cv2.imread(file, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise Exception('"{}" could not be read'.format(file))
+    return validated_image(img)
+
 
 class ImageLoader:
     def load_into(self, func):
         raise Exception('Raw usage of Image Loader forbidden, use FileImageLoader')
 
+    # registers name -> load function without decoding, loaders that can not defer just load
+    def register_into(self, func):
+        self.load_into(lambda name, img: func(name, lambda: img))
+
 
 class FileImageLoader(ImageLoader):
     def __init__(self, file=None, prefix=''):
         self.file = file
         self.prefix = prefix
 
+    def name(self):
+        return self.prefix + '/' + os.path.basename(self.file)
+
     def load_into(self, func):
-        img = cv2.imread(self.file, cv2.IMREAD_UNCHANGED)
-        func(self.prefix + '/' + os.path.basename(self.file), img)
+        func(self.name(), load_image_file(self.file))
+
+    def register_into(self, func):
+        func(self.name(), lambda: load_image_file(self.file))
 
 
 class DirectoryImageLoader(ImageLoader):
-    def __init__(self, directory=None, prefix=''):
+    def __init__(self, directory=None, prefix='', workers=None):
         self.directory = directory
         self.prefix = prefix
+        self.workers = workers
+
+    def files(self):
+        return [f for f in os.listdir(self.directory) if f.endswith('.png')]
+
+    def load_into(self, func):
+        files = self.files()
+        paths = [os.path.join(self.directory, f) for f in files]
+        if self.workers is not None and self.workers > 1:
+            # cv2 releases the GIL while decoding
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                images = list(executor.map(load_image_file, paths))
+        else:
+            images = map(load_image_file, paths)
+        for f, img in zip(files, images):
+            func(self.prefix + '/' + f, img)
+
+    def register_into(self, func):
+        for f in self.files():
+            func(self.prefix + '/' + f, lambda path=os.path.join(self.directory, f): load_image_file(path))
+
+
+class MappedImageLoader(ImageLoader):
+    def __init__(self, file=None, prefix=''):
+        self.file = file
+        self.prefix = prefix
+        self.store = None
+
+    def name(self, name):
+        if self.prefix == '':
+            return name
+        return self.prefix + '/' + name
 
     def load_into(self, func):
-        for f in os.listdir(self.directory):
-            if f.endswith('.png'):
-                img = cv2.imread(os.path.join(self.directory, f), cv2.IMREAD_UNCHANGED)
-                img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
-                func(self.prefix + '/' + f, img)
+        if self.store is None:
+            self.store = MappedStore(self.file)
+        for name in self.store.keys():
+            func(self.name(name), self.store.get(name))
+
+
+def build_asset_store(loaders, file):
+    images = {}
+
+    def add(name, img):
+        if name in images:
+            raise Exception('image with same name was loaded before! Use a prefix')
+        images[name] = validated_image(img)
+
+    for loader in loaders:
+        loader.load_into(add)
+    write_mapped_store(file, images)
+    return len(images)
+
+
+# name -> image like the dict it replaces, registered images are only decoded when read
+class ImageMemory(MutableMapping):
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.images = {}
+        self.registered = {}
+        self.loaded = LRUCache(max_bytes)
+        self.single_flight = SingleFlight()
+        self.generations = {}
+
+    # identifies the current image of a name, for caches of images derived from it
+    def key(self, name):
+        return 'memory', name, self.generations.get(name, 0)
+
+    def _changed(self, name):
+        self.generations[name] = self.generations.get(name, 0) + 1
+
+    def add(self, name, img):
+        if name in self:
+            raise Exception('image with same name was loaded before! Use a prefix')
+        self[name] = img
+
+    def register(self, name, load):
+        if name in self:
+            raise Exception('image with same name was loaded before! Use a prefix')
+        self.registered[name] = load
+
+    def _load(self, name):
+        img = self.registered[name]()
+        self.loaded.put(name, img, img.nbytes)
+        return img
+
+    def __getitem__(self, name):
+        if name in self.images:
+            return self.images[name]
+        if name not in self.registered:
+            raise KeyError(name)
+        img = self.loaded.get(name)
+        if img is None:
+            img = self.single_flight.run(name, lambda: self._load(name))
+        return img
+
+    # plain assignment replaces like a dict, add refuses duplicates
+    def __setitem__(self, name, img):
+        self.registered.pop(name, None)
+        self.loaded.pop(name)
+        self.images[name] = img
+        self._changed(name)
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.images.pop(name, None)
+        self.registered.pop(name, None)
+        self.loaded.pop(name)
+        self._changed(name)
+
+    def __contains__(self, name):
+        return name in self.images or name in self.registered
+
+    def __iter__(self):
+        yield from list(self.images.keys())
+        yield from list(self.registered.keys())
+
+    def __len__(self):
+        return len(self.images) + len(self.registered)
 
 
 class FontLoader:
@@ -0,0 +1,67 @@
+import json
+import numpy as np
+import os
+import struct
+
+MAPPED_STORE_MAGIC = b'IMGSTACK'
+MAPPED_STORE_ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + MAPPED_STORE_ALIGNMENT - 1) // MAPPED_STORE_ALIGNMENT * MAPPED_STORE_ALIGNMENT
+
+
+def write_mapped_store(file, arrays, meta=None):
+    index = {}
+    offset = 0
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        index[key] = [offset, list(arr.shape), arr.dtype.str]
+        offset = _aligned(offset + arr.nbytes)
+
+    header = json.dumps({'arrays': index, 'meta': meta or {}}).encode('utf-8')
+    data_offset = _aligned(len(MAPPED_STORE_MAGIC) + 8 + len(header))
+
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAPPED_STORE_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for key, arr in arrays.items():
+            f.seek(data_offset + index[key][0])
+            f.write(np.ascontiguousarray(arr).tobytes())
+        f.truncate(data_offset + offset)
+    os.replace(tmp, file)
+
+
+class MappedStore:
+    def __init__(self, file):
+        self.file = file
+        with open(file, 'rb') as f:
+            if f.read(len(MAPPED_STORE_MAGIC)) != MAPPED_STORE_MAGIC:
+                raise Exception('"{}" is not an imagestack mapped store'.format(file))
+            header_length = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_length).decode('utf-8'))
+
+        self.index = header['arrays']
+        self.meta = header['meta']
+        self.data_offset = _aligned(len(MAPPED_STORE_MAGIC) + 8 + header_length)
+        self.data = None
+        if os.path.getsize(file) > self.data_offset:
+            # read only mapping, the pages are shared by every process mapping the same file
+            self.data = np.memmap(file, dtype=np.uint8, mode='r', offset=self.data_offset)
+
+    def get(self, key):
+        offset, shape, dtype = self.index[key]
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        return self.data[offset:offset + size].view(dtype).reshape(shape)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
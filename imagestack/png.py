@@ -0,0 +1,68 @@
+import numpy as np
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_FILTER_UP = 2
+
+
+# writes an 8 bit rgba png row band by row band, without holding the whole image or its compressed form
+class PngStreamWriter:
+    def __init__(self, file, width, height, compression=3, chunk_bytes=1 << 20):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.chunk_bytes = chunk_bytes
+        self.compressor = zlib.compressobj(compression)
+        self.previous = np.zeros((1, width * 4), dtype=np.uint8)
+        self.rows = 0
+        self.pending = []
+        self.pending_bytes = 0
+
+        self.file.write(PNG_SIGNATURE)
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+    def write_rows(self, rgba):
+        if rgba.shape[1] != self.width or self.rows + rgba.shape[0] > self.height:
+            raise Exception('Rows of shape {} do not fit the {}x{} png'.format(rgba.shape, self.width, self.height))
+        rows = rgba.reshape(rgba.shape[0], self.width * 4)
+
+        # the up filter only needs the previous row and compresses smooth images much better than none
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = PNG_FILTER_UP
+        np.subtract(rows[:1], self.previous, out=filtered[:1, 1:])
+        np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        self.previous = rows[-1:].copy()
+        self.rows += rows.shape[0]
+
+        self.pending.append(self.compressor.compress(filtered))
+        self.pending_bytes += len(self.pending[-1])
+        if self.pending_bytes >= self.chunk_bytes:
+            self.flush()
+
+    def flush(self):
+        data = b''.join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        if len(data) > 0:
+            self.chunk(b'IDAT', data)
+
+    def close(self):
+        if self.rows != self.height:
+            raise Exception('{} of {} png rows were written'.format(self.rows, self.height))
+        self.pending.append(self.compressor.flush())
+        self.flush()
+        self.chunk(b'IEND', b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
@@ -0,0 +1,148 @@
+import cv2
+import numpy as np
+
+from .helpers import LINE_TYPE, point_on_circle, rectangle_shape
+
+
+# shapes are rasterized as single channel uint8 coverage masks, ColoredLayer.colored turns them into bgra
+
+def full_mask(shape):
+    # full coverage without allocating a pixel per pixel
+    return np.broadcast_to(np.uint8(255), shape)
+
+
+def _rectangle_corners(size, radius, line_width):
+    thick_offset = max(0, line_width)
+    bottom_right = rectangle_shape(size, radius, line_width)
+    bottom_right = (bottom_right[0] - max(1, thick_offset * 2), bottom_right[1] - max(1, thick_offset * 2))
+
+    #  corners:
+    #  p1 - p2
+    #  |     |
+    #  p4 - p3
+
+    p1 = (thick_offset, thick_offset)
+    p2 = (bottom_right[1], p1[1])
+    p3 = (bottom_right[1], bottom_right[0])
+    p4 = (p1[0], bottom_right[0])
+    return p1, p2, p3, p4
+
+
+def draw_rounded_rectangle(size, radius=0, line_width=-1):
+    src = np.zeros(rectangle_shape(size, radius, line_width), dtype=np.uint8)
+    p1, p2, p3, p4 = _rectangle_corners(size, radius, line_width)
+
+    corner_radius = abs(radius)
+    thickness = line_width
+
+    if thickness < 0:
+        # big rect
+        start_pos = (p1[0] + corner_radius, p1[1])
+        end_pos = (p3[0] - corner_radius, p3[1])
+        cv2.rectangle(src, start_pos, end_pos, 255, thickness=thickness, lineType=LINE_TYPE)
+        start_pos = (p1[0], p1[1] + corner_radius)
+        end_pos = (p3[0], p3[1] - corner_radius)
+        cv2.rectangle(src, start_pos, end_pos, 255, thickness=thickness, lineType=LINE_TYPE)
+
+    else:
+        # draw straight lines
+        cv2.line(src, (p1[0] + corner_radius, p1[1]), (p2[0] - corner_radius, p2[1]), 255, thickness, LINE_TYPE)
+        cv2.line(src, (p2[0], p2[1] + corner_radius), (p3[0], p3[1] - corner_radius), 255, thickness, LINE_TYPE)
+        cv2.line(src, (p3[0] - corner_radius, p4[1]), (p4[0] + corner_radius, p3[1]), 255, thickness, LINE_TYPE)
+        cv2.line(src, (p4[0], p4[1] - corner_radius), (p1[0], p1[1] + corner_radius), 255, thickness, LINE_TYPE)
+
+    if corner_radius > 0:
+        # draw arcs
+        cv2.ellipse(src, (p1[0] + corner_radius, p1[1] + corner_radius), (corner_radius, corner_radius),
+                    180.0, 0, 90, 255, thickness, LINE_TYPE)
+        cv2.ellipse(src, (p2[0] - corner_radius, p2[1] + corner_radius), (corner_radius, corner_radius),
+                    270.0, 0, 90, 255, thickness, LINE_TYPE)
+        cv2.ellipse(src, (p3[0] - corner_radius, p3[1] - corner_radius), (corner_radius, corner_radius),
+                    0.0, 0, 90, 255, thickness, LINE_TYPE)
+        cv2.ellipse(src, (p4[0] + corner_radius, p4[1] - corner_radius), (corner_radius, corner_radius),
+                    90.0, 0, 90, 255, thickness, LINE_TYPE)
+    return src
+
+
+def _coverage(distance):
+    # coverage of a one pixel wide box filter across the edge
+    return (np.clip(0.5 - distance, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+
+def _sdf_inside(qx, qy, r, offset):
+    # outside of the corners the distance is max(qx, qy) - r, so the coverage is the minimum of two vectors
+    mask = np.minimum(_coverage(qy - r - offset)[:, np.newaxis], _coverage(qx - r - offset))
+    rows, cols = np.flatnonzero(qy > 0), np.flatnonzero(qx > 0)
+    if len(rows) > 0 and len(cols) > 0:
+        corner = np.sqrt(np.square(qy[rows])[:, np.newaxis] + np.square(qx[cols]))
+        mask[np.ix_(rows, cols)] = _coverage(corner - r - offset)
+    return mask
+
+
+def sdf_rounded_rectangle(size, radius=0, line_width=-1):
+    shape = rectangle_shape(size, radius, line_width)
+    p1, _, p3, _ = _rectangle_corners(size, radius, line_width)
+
+    # same outline as the cv2 drawing, pixel centers lie on integer coordinates
+    grow = 0.5 if line_width < 0 else 0.0
+    center = ((p1[0] + p3[0]) * 0.5, (p1[1] + p3[1]) * 0.5)
+    half = (abs(p3[0] - p1[0]) * 0.5 + grow, abs(p3[1] - p1[1]) * 0.5 + grow)
+    r = min(abs(radius) + grow, half[0], half[1])
+
+    qx = np.abs(np.arange(shape[1], dtype=np.float32) - center[0]) - (half[0] - r)
+    qy = np.abs(np.arange(shape[0], dtype=np.float32) - center[1]) - (half[1] - r)
+
+    if line_width < 0:
+        return _sdf_inside(qx, qy, r, 0)
+    # a stroke of at least one pixel is the difference of two filled shapes
+    half_width = max(1, line_width) * 0.5
+    return _sdf_inside(qx, qy, r, half_width) - _sdf_inside(qx, qy, r, -half_width)
+
+
+# masks are read only, so they can be shared through a byte bounded LRUCache
+def _cached_mask(cache, key, build):
+    if cache is None:
+        return build()
+    mask = cache.get(key)
+    if mask is None:
+        mask = build()
+        cache.put(key, mask, mask.nbytes)
+    return mask
+
+
+# single channel coverage masks of rounded rectangles
+def rounded_rectangle_mask(size, radius=0, line_width=-1, antialias=False, cache=None):
+    return _cached_mask(cache, ('rectangle', tuple(size), radius, line_width, antialias),
+                        lambda: _rounded_rectangle_mask(tuple(size), radius, line_width, antialias))
+
+
+def _rounded_rectangle_mask(size, radius, line_width, antialias):
+    if antialias:
+        mask = sdf_rounded_rectangle(size, radius, line_width)
+    else:
+        mask = draw_rounded_rectangle(size, radius, line_width)
+    if radius < 0:
+        mask = 255 - mask
+    mask.flags.writeable = False
+    return mask
+
+
+# circle and slice lines of a PieLayer
+def pie_wheel_mask(radius, border_width=1, line_width=1, slices=1, angle_offset=270, cache=None):
+    return _cached_mask(cache, ('pie', radius, border_width, line_width, slices, angle_offset),
+                        lambda: _pie_wheel_mask(radius, border_width, line_width, slices, angle_offset))
+
+
+def _pie_wheel_mask(radius, border_width, line_width, slices, angle_offset):
+    half_border_width = int(border_width * 0.5)
+    adjusted_radius = radius - half_border_width - 1
+    center = (radius, radius)
+    slice_size = int(360 / slices)
+
+    src = np.zeros((radius * 2, radius * 2), dtype=np.uint8)
+    cv2.circle(src, center, adjusted_radius, 255, border_width)
+    for i in range(slices):
+        start = point_on_circle(angle=slice_size * i + angle_offset, radius=adjusted_radius, center=center)
+        cv2.line(src, start, center, 255, line_width, LINE_TYPE)
+    src.flags.writeable = False
+    return src
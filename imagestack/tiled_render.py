@@ -0,0 +1,122 @@
+from . import *
+from .png import PngStreamWriter
+from .visitor_create import VisitorCreate
+from concurrent.futures import ThreadPoolExecutor
+import os
+import cv2
+import numpy as np
+
+
+def _span(region, axis):
+    return region[0][axis].start, region[0][axis].stop
+
+
+# renders an ImageStack band by band straight into a png stream, the full canvas is never allocated
+#
+# the first layer has to be a ColorLayer at the origin, its plain color or gradient is generated per tile.
+# a band is tile_size rows of the canvas, its tiles are composited in parallel.
+# the other layers are rasterized whole and serially on the calling thread, when the first band their extent
+# reaches is rendered, and released after the last band they cover.
+# so the peak memory is one band plus the layers crossing it, and a single huge layer is not sped up by tiling.
+class TiledRender:
+    def __init__(self, stack, image_creator, tile_size=512, workers=None):
+        if isinstance(tile_size, int):
+            tile_size = (tile_size, tile_size)
+        self.stack = stack
+        self.tile_size = tile_size
+        self.workers = workers or os.cpu_count() or 1
+        self.visitor = VisitorCreate(image_creator)
+        self.canvas_shape = None
+        self.pending = []
+        self.active = []
+
+    def canvas_tile(self, rows, cols):
+        layer = self.stack.layers[0]
+        color = np.broadcast_to(layer.color.create_broadcast(self.canvas_shape), self.canvas_shape + (4,))
+        return self.visitor.output(np.ascontiguousarray(color[rows, cols]))
+
+    def init_canvas(self):
+        layer = self.stack.layers[0]
+        # anything else would have to be rasterized at the full canvas size
+        if not isinstance(layer, ColorLayer):
+            raise Exception('The first layer of a tiled render has to be a ColorLayer, not a {}!'
+                            .format(type(layer).__name__))
+        # the first layer is the canvas, create ignores its placement as well
+        if tuple(layer.pos) != (0, 0):
+            raise Exception('The first layer of a tiled render defines the canvas and can not be moved to {}!'
+                            .format(tuple(layer.pos)))
+        self.canvas_shape = (layer.resize[1], layer.resize[0])
+
+    def band_of(self, row):
+        return row // self.tile_size[1]
+
+    def init_layers(self):
+        for index, layer in enumerate(self.stack.layers[1:]):
+            if self.visitor.skipped(layer, self.canvas_shape):
+                continue
+            width, height = layer.accept(self.visitor.extents)
+            region = overlay_region(self.canvas_shape, (height, width), layer.pos[0], layer.pos[1],
+                                    layer.max_size, layer.align_x, layer.align_y)
+            self.pending.append((self.band_of(_span(region, 0)[0]), index, layer))
+
+    def rasterize(self, band):
+        # rasterized on the calling thread, the visitor is not thread safe
+        ready = [entry for entry in self.pending if entry[0] <= band]
+        self.pending = [entry for entry in self.pending if entry[0] > band]
+        for _, index, layer in ready:
+            fg = layer.accept(self.visitor)
+            if fg is None:
+                continue
+            region = overlay_region(self.canvas_shape, fg.shape, layer.pos[0], layer.pos[1], layer.max_size,
+                                    layer.align_x, layer.align_y)
+            if region is None:
+                continue
+            rows, cols = _span(region, 0), _span(region, 1)
+            if rows[1] <= rows[0] or cols[1] <= cols[0]:
+                continue
+            self.active.append((index, fg[region[1]], rows, cols, self.band_of(rows[1] - 1)))
+        # composited in stack order, whichever band a layer starts in
+        self.active.sort(key=lambda entry: entry[0])
+
+    def composite(self, band_img, rows, cols):
+        tile = band_img[:, cols[0]:cols[1]]
+        canvas = self.canvas_tile(slice(*rows), slice(*cols))
+        tile[:] = canvas
+        self.visitor.buffers.release(canvas)
+        for _, fg, fg_rows, fg_cols, _ in self.active:
+            y0, y1 = max(rows[0], fg_rows[0]), min(rows[1], fg_rows[1])
+            x0, x1 = max(cols[0], fg_cols[0]), min(cols[1], fg_cols[1])
+            if y1 <= y0 or x1 <= x0:
+                continue
+            part = fg[y0 - fg_rows[0]:y1 - fg_rows[0], x0 - fg_cols[0]:x1 - fg_cols[0]]
+            overlay(tile, part, x0 - cols[0], y0 - rows[0], in_place=True, premultiplied=self.visitor.premultiplied)
+
+    async def write(self, file, compression=3):
+        self.init_canvas()
+        await self.visitor.gather(self.stack, self.stack.canvas_size())
+        self.init_layers()
+
+        height, width = self.canvas_shape
+        buffers = self.visitor.buffers
+        tile_height, tile_width = self.tile_size[1], self.tile_size[0]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='imagestack-tile') as executor, \
+                PngStreamWriter(file, width, height, compression=compression) as png:
+            for y in range(0, height, tile_height):
+                band = self.band_of(y)
+                rows = (y, min(y + tile_height, height))
+                self.rasterize(band)
+
+                band_img = buffers.get((rows[1] - rows[0], width, 4))
+                tiles = [(x, min(x + tile_width, width)) for x in range(0, width, tile_width)]
+                for _ in executor.map(lambda cols: self.composite(band_img, rows, cols), tiles):
+                    pass
+
+                if self.visitor.premultiplied:
+                    unpremultiply(band_img, band_img)
+                png.write_rows(cv2.cvtColor(band_img, cv2.COLOR_BGRA2RGBA, dst=band_img))
+                buffers.release(band_img)
+
+                for layer in self.active:
+                    if layer[4] <= band:
+                        buffers.release(layer[1])
+                self.active = [layer for layer in self.active if layer[4] > band]
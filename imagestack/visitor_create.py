@@ -1,25 +1,113 @@
 from . import *
 from .visitor import Visitor
+from .visitor_gather import VisitorGather
+from .visitor_fingerprint import VisitorFingerprint
+from .visitor_extent import VisitorExtent
+from .visitor_skip import VisitorSkip
 import numpy as np
 import cv2
-import os
-import requests
-import warnings
 from PIL import Image, ImageDraw
 
 
 class VisitorCreate(Visitor):
-    def __init__(self, image_creator):
+    def __init__(self, image_creator, scaler=None):
         self.image_creator = image_creator
+        self.scaler = scaler
+        self.gatherer = VisitorGather(image_creator, scaler)
+        self.fingerprinter = VisitorFingerprint()
+        self.extents = VisitorExtent()
+        self.skipper = VisitorSkip(self.gatherer)
+        self.early_culled = self.gatherer.skipped
+        self.premultiplied = image_creator.premultiplied
+        self.buffers = image_creator.buffers
+        self.gathered = {}
+
+    # loads every i/o bound layer of the stack concurrently, before the cpu bound compositing.
+    # with the canvas size known upfront, culled layers are decided first and nothing is loaded for them
+    async def gather(self, el, canvas_size=None):
+        if canvas_size is not None:
+            canvas_shape = (canvas_size[1], canvas_size[0])
+            for layer in el.layers[1:]:
+                if self.culled(layer, canvas_shape):
+                    self.early_culled.add(id(layer))
+        el.accept(self.gatherer)
+        if len(self.gatherer.jobs) > 0:
+            self.gathered = await run_all(self.image_creator.io_executor, self.gatherer.jobs)
+
+    def load(self, job):
+        key, func = job
+        if key not in self.gathered:
+            return func()
+        result = self.gathered[key]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # layer outputs are kept premultiplied while compositing if the image creator asks for it
+    def output(self, img):
+        if not self.premultiplied or img is None:
+            return img
+        # buffers of this render are premultiplied in place, shared images into a new buffer
+        if self.buffers.owns(img):
+            return premultiply(img, img)
+        return premultiply(img, self.buffers.get(img.shape))
+
+    # colors a coverage mask into a pooled buffer
+    def colored(self, el, mask):
+        return self.output(el.colored(mask, self.buffers.get(mask.shape[:2] + (4,))))
+
+    def blend(self, background, foreground):
+        if self.premultiplied:
+            return overlay_premultiplied_matching(background, foreground)
+        return overlay_matching(background, foreground)
+
+    # layers that can not contribute a pixel to the canvas are not rasterized at all
+    def culled(self, layer, canvas_shape):
+        width, height = layer.accept(self.extents)
+        region = overlay_region(canvas_shape, (height, width), layer.pos[0], layer.pos[1], layer.max_size,
+                                layer.align_x, layer.align_y)
+        if region is not None:
+            b_region = region[0]
+            if b_region[0].stop > b_region[0].start and b_region[1].stop > b_region[1].start:
+                return False
+        self.image_creator.count_culled()
+        return True
+
+    # a culled layer is not rasterized, but initializes its nested layers like a rendered one
+    def skipped(self, layer, canvas_shape):
+        if id(layer) not in self.early_culled and not self.culled(layer, canvas_shape):
+            return False
+        layer.accept(self.skipper)
+        return True
 
     def visit_ImageStack(self, el):
         img = None
+        owned = False
         for layer in el.layers:
+            # the first layer defines the canvas, even if it is transparent
+            if img is not None and self.skipped(layer, img.shape):
+                continue
             fg = layer.accept(self)
-
-            img = overlay(img, fg, layer.pos[0], layer.pos[1], layer.max_size, layer.align_x, layer.align_y)
+            if img is None and fg is None:
+                # the canvas comes from a later layer, the size the early culling assumed was wrong
+                self.early_culled.clear()
+
+            # the first layer output may be shared, then the canvas is copied once and composited in place
+            if img is not None and fg is not None and not owned:
+                if not self.buffers.owns(img):
+                    img = self.copied(img)
+                owned = True
+            img = overlay(img, fg, layer.pos[0], layer.pos[1], layer.max_size, layer.align_x, layer.align_y,
+                          in_place=True, premultiplied=self.premultiplied)
+            if fg is not img:
+                self.buffers.release(fg)
         return img
 
+    def copied(self, img):
+        copy = self.buffers.get(img.shape)
+        np.copyto(copy, img)
+        return copy
+
     def visit_AnimatedImageStack(self, el):
         el.animated._init()
         el.animated.create_init(self)
@@ -27,20 +115,24 @@ class VisitorCreate(Visitor):
         fgimage = None
         if el.static_fg is not False:
             el.static_fg._init()
-            fgimage = self.visit_ImageStack(el.static_fg)
-            fgimage = cv2.cvtColor(fgimage, cv2.COLOR_RGBA2BGRA)
+            canvas = self.visit_ImageStack(el.static_fg)
+            fgimage = cv2.cvtColor(canvas, cv2.COLOR_RGBA2BGRA)
+            self.buffers.release(canvas)
 
         bgimage = None
         if el.static_bg is not False:
             el.static_bg._init()
-            bgimage = self.visit_ImageStack(el.static_bg)
-            bgimage = cv2.cvtColor(bgimage, cv2.COLOR_RGBA2BGRA)
+            canvas = self.visit_ImageStack(el.static_bg)
+            bgimage = cv2.cvtColor(canvas, cv2.COLOR_RGBA2BGRA)
+            self.buffers.release(canvas)
 
         image_data = []
         for i in list(np.arange(0, 1, 1 / (el.fps * el.seconds))) + [1]:
             t = el.animated.create_progress(i)
-            t = overlay(bgimage, t)
-            t = overlay(t, fgimage)
+            t = overlay(bgimage, t, premultiplied=self.premultiplied)
+            t = overlay(t, fgimage, premultiplied=self.premultiplied)
+            if self.premultiplied:
+                t = unpremultiply(t)
 
             t = Image.fromarray(t)
 
@@ -55,7 +147,7 @@ class VisitorCreate(Visitor):
         raise Exception('Raw usage of ColoredLayer.create is forbidden, use ColorLayer!')
 
     def visit_ColorLayer(self, el):
-        return el.colored(np.full((el.resize[1], el.resize[0], 4), ALPHA_COLOR, dtype=np.uint8))
+        return self.colored(el, full_mask((el.resize[1], el.resize[0])))
 
     def visit_EmptyLayer(self, el):
         return self.visit_ColorLayer(el)
@@ -63,50 +155,44 @@ class VisitorCreate(Visitor):
     def visit_ImageLayer(self, el):
         raise Exception('Raw usage of ImageLayer.create forbidden, use FileImageLayer')
 
+    # in a scaled render, images without a resize are scaled once the loaded size is known
+    def resized(self, el, img, key=None):
+        if self.scaler is not None and el.resize is False:
+            el.resize = (self.scaler.size(img.shape[1]), self.scaler.size(img.shape[0]))
+        return self.output(el.resized(img, self.image_creator.resized_images, key))
+
     def visit_FileImageLayer(self, el):
-        img = cv2.imread(el.file, cv2.IMREAD_UNCHANGED)
-        img = el.validated(img)
-        return el.resized(img)
+        img = self.load(self.gatherer.file_job(el))
+        return self.resized(el, img)
 
     def visit_MemoryImageLayer(self, el):
-        img = self.image_creator.image_memory[el.memory]
+        img = self.load(self.gatherer.memory_job(el))
         img = el.validated(img)
-        return el.resized(img)
+        return self.resized(el, img, self.image_creator.image_memory.key(el.memory))
 
     def visit_WebImageLayer(self, el):
         try:
-            img_bytes = requests.get(el.url).content
-            img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_UNCHANGED)
+            img = self.load(self.gatherer.web_job(el))
         except:
             return None
         if img is None:
             return None
         img = el.validated(img)
-        return el.resized(img)
+        return self.resized(el, img)
 
     def visit_EmojiLayer(self, el):
-        if el.emoji is None:
-            emoji_id = from_char(self.image_creator.emoji_fallback)
-        else:
-            emoji_id = from_char(el.emoji)
-        file = None
-        if self.image_creator.emoji_path is not None:
-            file = os.path.join(self.image_creator.emoji_path, emoji_id + '.png')
-        img = None
-        if file is not None and os.path.exists(file):
-            img = cv2.imread(file, cv2.IMREAD_UNCHANGED)
-        elif self.image_creator.download_emojis:
-            url = el.get_emoji_image_url(self.image_creator.download_emoji_provider)
-            if url is None:
-                warnings.warn('Emoji "{}" was not found on "{}"!'.format(el.emoji, el.base_emoji_url))
-            else:
-                img_bytes = requests.get(url).content
-                img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_UNCHANGED)
-                if self.image_creator.save_downloaded_emojis:
-                    cv2.imwrite(file, img)
-
+        emoji = self.image_creator.emoji_char(el.emoji)
+        atlas = self.image_creator.emoji_atlas
+        if atlas is not None:
+            img = atlas.get(emoji, el.resize, self.image_creator.resized_images)
+            if img is not None:
+                return self.resized(el, img, atlas.key(emoji, el.resize))
+
+        img = self.load(self.gatherer.emoji_job(el))
+        if img is None:
+            return None
         img = el.validated(img)
-        return el.resized(img)
+        return self.resized(el, img)
 
     def visit_TextLayer(self, el):
         if sum(map(len, el.text_lines)) == 0:
@@ -116,7 +202,7 @@ class VisitorCreate(Visitor):
 
         total_width, total_height, line_widths, line_heights, descent = el.get_text_dimensions(font)
 
-        img = Image.new("RGBA", (total_width, total_height), color=(0, 0, 0, 0))
+        img = Image.new("L", (total_width, total_height), color=0)
 
         draw = ImageDraw.Draw(img)
 
@@ -129,28 +215,49 @@ class VisitorCreate(Visitor):
                 x = int(total_width / 2 - line_widths[i] / 2)
             elif el.text_align == 'right':
                 x = total_width - line_widths[i]
-            draw.text((x, y - descent), el.text_lines[i], ALPHA_COLOR, font=font)
+            draw.text((x, y - descent), el.text_lines[i], 255, font=font)
             y += line_heights[i]
 
-        img = el.colored(np.array(img))
+        img = self.colored(el, np.array(img))
 
         bg_max_size_x = total_width + (el.background_padding[0] * 2)
         bg_max_size_y = total_height + (el.background_padding[1] * 2)
+        bg_shape = rectangle_shape((bg_max_size_x, bg_max_size_y), el.border_radius)
+        region = overlay_region(bg_shape, img.shape,
+                                x=int(bg_max_size_x / 2), y=int(bg_max_size_y / 2) + 1,
+                                align_x='center', align_y='center',
+                                max_size=(bg_max_size_x, bg_max_size_y)
+                                )
+
+        # a transparent background contributes nothing, so the text only needs to be padded
+        if el.background_color.is_fully_transparent():
+            bg_img = self.buffers.get((bg_shape[0], bg_shape[1], 4))
+            bg_img.fill(0)
+            if region is not None:
+                b_region, f_region = region
+                text = bg_img[b_region]
+                text[...] = img[f_region]
+                if not self.premultiplied:
+                    # uncovered pixels are transparent black, as compositing onto the background left them
+                    np.copyto(text.view(np.uint32)[..., 0], 0, where=text[..., 3] == 0)
+            self.buffers.release(img)
+            return bg_img
+
         bg_layer = RectangleLayer(color=el.background_color,
                                   size=(bg_max_size_x, bg_max_size_y),
                                   radius=el.border_radius)
         bg_layer._init()
         bg_img = bg_layer.accept(self)
 
-        img = overlay(bg_img, img,
-                      x=int(bg_max_size_x / 2), y=int(bg_max_size_y / 2) + 1,
-                      align_x='center', align_y='center',
-                      max_size=(bg_max_size_x, bg_max_size_y)
-                      )
-        return img
+        if region is not None:
+            b_region, f_region = region
+            bg_img[b_region] = self.blend(bg_img[b_region], img[f_region])
+        self.buffers.release(img)
+        return bg_img
 
     def visit_LineLayer(self, el):
-        src = np.zeros((abs(el.target[1]), abs(el.target[0]), 4), dtype=np.uint8)
+        src = self.buffers.get((abs(el.target[1]), abs(el.target[0])))
+        src.fill(0)
         start = [0, 0]
         end = [abs(el.target[0]), abs(el.target[1])]
         if el.target[0] < 0:
@@ -160,135 +267,79 @@ class VisitorCreate(Visitor):
             start[1] = end[1]
             end[1] = 0
 
-        cv2.line(src, start, end, ALPHA_COLOR, el.line_width, LINE_TYPE)
-        return el.colored(src)
+        cv2.line(src, start, end, 255, el.line_width, LINE_TYPE)
+        img = self.colored(el, src)
+        self.buffers.release(src)
+        return img
 
     def visit_RectangleLayer(self, el):
-        diameter = el.radius * 2
-
-        thick_offset = max(0, el.line_width)
-        double_thickoff = max(1, thick_offset * 2)
-
-        mthick_offset = max(1, thick_offset)
-        top_left = (thick_offset, thick_offset)
-        bottom_right = (max(1, diameter - mthick_offset, el.size[1] - mthick_offset),
-                        max(1, diameter - mthick_offset, el.size[0] - mthick_offset))
-
-        src = np.zeros((bottom_right[0] + double_thickoff, bottom_right[1] + double_thickoff, 4), dtype=np.uint8)
-
-        #  corners:
-        #  p1 - p2
-        #  |     |
-        #  p4 - p3
-
-        p1 = top_left
-        p2 = (bottom_right[1], top_left[1])
-        p3 = (bottom_right[1], bottom_right[0])
-        p4 = (top_left[0], bottom_right[0])
-
-        corner_radius = abs(el.radius)
-        thickness = el.line_width
-
-        if thickness < 0:
-            # big rect
-            start_pos = (p1[0] + corner_radius, p1[1])
-            end_pos = (p3[0] - corner_radius, p3[1])
-            cv2.rectangle(src, start_pos, end_pos, ALPHA_COLOR, thickness=thickness, lineType=LINE_TYPE)
-            start_pos = (p1[0], p1[1] + corner_radius)
-            end_pos = (p3[0], p3[1] - corner_radius)
-            cv2.rectangle(src, start_pos, end_pos, ALPHA_COLOR, thickness=thickness, lineType=LINE_TYPE)
-
-        else:
-            # draw straight lines
-            cv2.line(src, (p1[0] + corner_radius, p1[1]), (p2[0] - corner_radius, p2[1]), ALPHA_COLOR, thickness,
-                     LINE_TYPE)
-            cv2.line(src, (p2[0], p2[1] + corner_radius), (p3[0], p3[1] - corner_radius), ALPHA_COLOR, thickness,
-                     LINE_TYPE)
-            cv2.line(src, (p3[0] - corner_radius, p4[1]), (p4[0] + corner_radius, p3[1]), ALPHA_COLOR, thickness,
-                     LINE_TYPE)
-            cv2.line(src, (p4[0], p4[1] - corner_radius), (p1[0], p1[1] + corner_radius), ALPHA_COLOR, thickness,
-                     LINE_TYPE)
-
-        if corner_radius > 0:
-            # draw arcs
-            cv2.ellipse(src, (p1[0] + corner_radius, p1[1] + corner_radius), (corner_radius, corner_radius),
-                        180.0, 0, 90, ALPHA_COLOR, thickness, LINE_TYPE)
-            cv2.ellipse(src, (p2[0] - corner_radius, p2[1] + corner_radius), (corner_radius, corner_radius),
-                        270.0, 0, 90, ALPHA_COLOR, thickness, LINE_TYPE)
-            cv2.ellipse(src, (p3[0] - corner_radius, p3[1] - corner_radius), (corner_radius, corner_radius),
-                        0.0, 0, 90, ALPHA_COLOR, thickness, LINE_TYPE)
-            cv2.ellipse(src, (p4[0] + corner_radius, p4[1] - corner_radius), (corner_radius, corner_radius),
-                        90.0, 0, 90, ALPHA_COLOR, thickness, LINE_TYPE)
-
-        if el.radius < 0:
-            src = invert_image(src)
-
-        return el.colored(src)
+        return self.colored(el, rounded_rectangle_mask(el.size, el.radius, el.line_width, el.antialias,
+                                                         self.image_creator.masks))
 
     def visit_ProgressLayer(self, el):
         return self.visit_RectangleLayer(el)
 
-    def visit_PieLayer(self, el):
-        angle_offset = 270
+    # renders a layer, rotated around its center, reusing earlier renders of identical layers
+    def sprite(self, el, angle=None):
+        fingerprint = el.accept(self.fingerprinter)
+        if fingerprint is None:
+            return self.rotated(el.accept(self), angle)
 
-        diameter = el.radius * 2
-        radius = el.radius
-        half_border_width = int(el.border_width * 0.5)
+        key = (fingerprint, angle)
+        img = self.image_creator.sprites.get(key)
+        if img is None:
+            img = self.rotated(el.accept(self), angle)
+            if img is not None:
+                # owned by the sprite cache from now on
+                self.buffers.forget(img)
+                img.flags.writeable = False
+                self.image_creator.sprites.put(key, img, img.nbytes)
+        return img
 
-        adjusted_radius = radius - half_border_width - 1
+    def rotated(self, img, angle):
+        if img is None or angle is None:
+            return img
+        rotated = rotate_image(img, angle=angle, padding=True)
+        self.buffers.release(img)
+        return rotated
 
+    def visit_PieLayer(self, el):
+        angle_offset = 270
+        radius = el.radius
         center = (radius, radius)
 
-        src = np.zeros((diameter, diameter, 4), dtype=np.uint8)
-
         slices = len(el.choices)
         slice_size = int(360 / slices)
         half_slice_size = int(slice_size * 0.5)
 
-        cv2.circle(src,
-                   center,
-                   adjusted_radius,
-                   ALPHA_COLOR,
-                   el.border_width)
-
-        for i in range(slices):
-            start = point_on_circle(angle=slice_size * i + angle_offset,
-                                    radius=adjusted_radius,
-                                    center=center)
-
-            cv2.line(src,
-                     start,
-                     center,
-                     ALPHA_COLOR,
-                     el.line_width,
-                     LINE_TYPE)
-
-        img = el.colored(src)
+        img = self.colored(el, pie_wheel_mask(radius, el.border_width, el.line_width, slices, angle_offset,
+                                                 self.image_creator.masks))
 
         for i in range(slices):
             c = point_on_circle(angle=slice_size * i + half_slice_size + angle_offset,
                                 radius=int(el.choices_radius),
                                 center=center)
 
-            el.choices[i]._init()
-            cimg = el.choices[i].accept(self)
+            self.gatherer.init_nested(el.choices[i])
+            angle = None
+            if el.rotate_choices:
+                angle = -(slice_size * i + half_slice_size)
+            cimg = self.sprite(el.choices[i], angle)
 
             if cimg is not None:
-                if el.rotate_choices:
-                    cimg = rotate_image(cimg, angle=-(slice_size * i + half_slice_size), padding=True)
-
                 ho1, wo1 = int(cimg.shape[0] * 0.5), int(cimg.shape[1] * 0.5)
                 ho2, wo2 = cimg.shape[0] - ho1, cimg.shape[1] - wo1
                 img[c[1] - ho1:c[1] + ho2, c[0] - wo1:c[0] + wo2] = cimg
+                self.buffers.release(cimg)
 
         return img
 
     def visit_ListLayer(self, el):
-        img = None
+        items = []
         for i in range(el.repeat):
-            el.template._init()
-            img = el.concat(img, el.template.accept(self))
-            if i < el.repeat - 1:
-                img = el.concat_margin(img)
-
+            self.gatherer.init_nested(el.template)
+            items.append(self.sprite(el.template))
+        img = el.assemble(items, self.buffers)
+        for item in items:
+            self.buffers.release(item)
         return img
@@ -0,0 +1,56 @@
+from . import *
+from .visitor import Visitor
+
+UNBOUNDED = 1 << 30
+
+
+# upper bound (width, height) of what an initialized layer rasterizes to, without rasterizing it
+class VisitorExtent(Visitor):
+    def colored(self, el, size):
+        if el.color.is_fully_transparent():
+            return 0, 0
+        return size
+
+    def visit_ColorLayer(self, el):
+        return self.colored(el, (el.resize[0], el.resize[1]))
+
+    def visit_EmptyLayer(self, el):
+        return self.visit_ColorLayer(el)
+
+    def image(self, el):
+        if el.resize is False:
+            return UNBOUNDED, UNBOUNDED
+        return el.resize[0], el.resize[1]
+
+    def visit_FileImageLayer(self, el):
+        return self.image(el)
+
+    def visit_MemoryImageLayer(self, el):
+        return self.image(el)
+
+    def visit_WebImageLayer(self, el):
+        return self.image(el)
+
+    def visit_EmojiLayer(self, el):
+        return self.image(el)
+
+    def visit_TextLayer(self, el):
+        if el.color.is_fully_transparent() and el.background_color.is_fully_transparent():
+            return 0, 0
+        return UNBOUNDED, UNBOUNDED
+
+    def visit_RectangleLayer(self, el):
+        shape = rectangle_shape(el.size, el.radius, el.line_width)
+        return self.colored(el, (shape[1], shape[0]))
+
+    def visit_ProgressLayer(self, el):
+        return self.visit_RectangleLayer(el)
+
+    def visit_LineLayer(self, el):
+        return self.colored(el, (abs(el.target[0]), abs(el.target[1])))
+
+    def visit_PieLayer(self, el):
+        return el.radius * 2, el.radius * 2
+
+    def visit_ListLayer(self, el):
+        return UNBOUNDED, UNBOUNDED
@@ -0,0 +1,86 @@
+from . import *
+from .visitor import Visitor
+import numpy as np
+
+
+class Unfingerprintable(Exception):
+    pass
+
+
+# hashable key of what an initialized layer renders to, None if the output can change between renders
+class VisitorFingerprint(Visitor):
+    ignored_attributes = ('kwargs', 'used_kwargs')
+
+    def value(self, value):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, (np.integer, np.floating)):
+            return value.item()
+        if isinstance(value, SingleColor):
+            return 'color', value.bgra
+        if isinstance(value, LinearGradientColor):
+            return 'gradient', resolved_color(value.color1).bgra, resolved_color(value.color2).bgra, value.direction_axis
+        if isinstance(value, (list, tuple)):
+            return tuple(self.value(v) for v in value)
+        raise Unfingerprintable(type(value).__name__)
+
+    def attributes(self, el):
+        try:
+            return (type(el).__name__,) + tuple(
+                (k, self.value(v)) for k, v in sorted(vars(el).items()) if k not in self.ignored_attributes
+            )
+        except Unfingerprintable:
+            return None
+
+    def visit_ImageStack(self, el):
+        layers = tuple(layer.accept(self) for layer in el.layers)
+        if None in layers:
+            return None
+        return ('ImageStack',) + layers
+
+    def visit_AnimatedImageStack(self, el):
+        return None
+
+    def visit_ColorLayer(self, el):
+        return self.attributes(el)
+
+    def visit_EmptyLayer(self, el):
+        return self.attributes(el)
+
+    # files and memory entries can be replaced and remote images change, they are never reused
+
+    def visit_FileImageLayer(self, el):
+        return None
+
+    def visit_MemoryImageLayer(self, el):
+        return None
+
+    def visit_WebImageLayer(self, el):
+        return None
+
+    def visit_EmojiLayer(self, el):
+        return self.attributes(el)
+
+    def visit_TextLayer(self, el):
+        return self.attributes(el)
+
+    def visit_RectangleLayer(self, el):
+        return self.attributes(el)
+
+    def visit_LineLayer(self, el):
+        return self.attributes(el)
+
+    def visit_ProgressLayer(self, el):
+        return self.attributes(el)
+
+    # nested layers are initialized while rendering, their variables are not resolved yet
+
+    def visit_PieLayer(self, el):
+        return None
+
+    def visit_ListLayer(self, el):
+        return None
+
+
+def layer_fingerprint(el):
+    return el.accept(VisitorFingerprint())
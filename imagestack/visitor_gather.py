@@ -0,0 +1,105 @@
+from . import *
+from .visitor import Visitor
+import copy
+
+
+class VisitorGather(Visitor):
+    # kwargs that hold nested layers
+    nested_kwargs = ('layers', 'template', 'choices')
+
+    def __init__(self, image_creator, scaler=None):
+        self.image_creator = image_creator
+        self.scaler = scaler
+        self.jobs = {}
+        # ids of layers culled before gathering, nothing is loaded for them
+        self.skipped = set()
+
+    # nested layers are initialized from their kwargs, a scaled render scales them again afterwards
+    def init_nested(self, el):
+        el._init()
+        if self.scaler is not None:
+            el.accept(self.scaler)
+
+    # whether uninitialized nested layers contain anything to load, judged from their kwargs without initializing
+    def loadable(self, el):
+        if isinstance(el, (list, tuple)):
+            return any(self.loadable(x) for x in el)
+        if isinstance(el, ImageLayer):
+            return True
+        if not isinstance(el, VariableKwargManager):
+            return False
+        for key in self.nested_kwargs:
+            value = el.kwargs.get(key)
+            # layers only known once a variable is resolved might load something
+            if isinstance(value, VariableInterface) or (value is not None and self.loadable(value)):
+                return True
+        return False
+
+    def add_job(self, key, func):
+        if key not in self.jobs:
+            self.jobs[key] = func
+
+    def visit_ImageStack(self, el):
+        for layer in el.layers:
+            if id(layer) not in self.skipped:
+                layer.accept(self)
+
+    def visit_AnimatedImageStack(self, el):
+        # initializing consumes iterator variables, so the gathering only works on copies
+        el = copy.deepcopy(el)
+        el.animated._init()
+        el.animated.rotate._init()
+        self.visit_ImageStack(el.animated.rotate)
+        for stack in [el.static_fg, el.static_bg]:
+            if stack is not False:
+                stack._init()
+                self.visit_ImageStack(stack)
+
+    # (key, blocking load function) of the i/o bound layers, shared with VisitorCreate
+
+    def file_job(self, el):
+        file, target_size = el.file, el.target_size()
+        return ('file', file, target_size), lambda: self.image_creator.file_images.get(file, target_size=target_size)
+
+    def memory_job(self, el):
+        memory = el.memory
+        return ('memory', memory), lambda: self.image_creator.image_memory[memory]
+
+    def web_job(self, el):
+        url, target_size = el.url, el.target_size()
+        return ('web', url, target_size), lambda: self.image_creator.web_images.get(url, target_size)
+
+    def emoji_job(self, el):
+        emoji, target_size = self.image_creator.emoji_char(el.emoji), el.target_size()
+        return ('emoji', emoji, target_size), lambda: self.image_creator.load_emoji(el)
+
+    def visit_FileImageLayer(self, el):
+        self.add_job(*self.file_job(el))
+
+    def visit_MemoryImageLayer(self, el):
+        self.add_job(*self.memory_job(el))
+
+    def visit_WebImageLayer(self, el):
+        self.add_job(*self.web_job(el))
+
+    def visit_EmojiLayer(self, el):
+        emoji = self.image_creator.emoji_char(el.emoji)
+        if self.image_creator.emoji_atlas is not None and emoji in self.image_creator.emoji_atlas:
+            return
+        self.add_job(*self.emoji_job(el))
+
+    def visit_PieLayer(self, el):
+        if not self.loadable(el.choices):
+            return
+        for choice in el.choices:
+            choice = copy.deepcopy(choice)
+            self.init_nested(choice)
+            choice.accept(self)
+
+    def visit_ListLayer(self, el):
+        if not self.loadable(el.template):
+            return
+        template = copy.deepcopy(el.template)
+        for i in range(el.repeat):
+            self.init_nested(template)
+            template.accept(self)
@@ -0,0 +1,90 @@
+from . import *
+from .visitor import Visitor
+
+
+# scales the geometry of initialized layers in place, so a stack can be rasterized at its output resolution
+class VisitorScale(Visitor):
+    def __init__(self, factor):
+        self.factor = factor
+
+    def length(self, value):
+        return int(round(value * self.factor))
+
+    def size(self, value):
+        # truncated like the cv2.resize of the full render, but never collapsed
+        return max(1, int(value * self.factor))
+
+    def width(self, value):
+        # negative widths mean filled
+        if value <= 0:
+            return value
+        return max(1, self.length(value))
+
+    def lengths(self, values):
+        return tuple(self.length(v) for v in values)
+
+    def aligned(self, el):
+        el.pos = self.lengths(el.pos)
+        el.max_size = tuple(v if v < 0 else self.length(v) for v in el.max_size)
+
+    def visit_ImageStack(self, el):
+        for layer in el.layers:
+            layer.accept(self)
+
+    def visit_ColorLayer(self, el):
+        self.aligned(el)
+        el.resize = tuple(self.size(v) for v in el.resize)
+
+    def visit_EmptyLayer(self, el):
+        self.visit_ColorLayer(el)
+
+    def image(self, el):
+        self.aligned(el)
+        if el.resize is not False:
+            el.resize = tuple(self.size(v) for v in el.resize)
+
+    def visit_FileImageLayer(self, el):
+        self.image(el)
+
+    def visit_MemoryImageLayer(self, el):
+        self.image(el)
+
+    def visit_WebImageLayer(self, el):
+        self.image(el)
+
+    def visit_EmojiLayer(self, el):
+        self.image(el)
+
+    def visit_TextLayer(self, el):
+        self.aligned(el)
+        el.font_size = max(1, self.length(el.font_size))
+        el.background_padding = self.lengths(el.background_padding)
+        el.border_radius = self.length(el.border_radius)
+        el.line_margin = self.length(el.line_margin)
+
+    def visit_RectangleLayer(self, el):
+        self.aligned(el)
+        el.size = tuple(self.size(v) for v in el.size)
+        el.radius = self.length(el.radius)
+        el.line_width = self.width(el.line_width)
+
+    def visit_ProgressLayer(self, el):
+        self.visit_RectangleLayer(el)
+
+    def visit_LineLayer(self, el):
+        self.aligned(el)
+        el.target = self.lengths(el.target)
+        el.line_width = self.width(el.line_width)
+
+    # choices and templates are initialized while rendering, VisitorGather and VisitorCreate scale them then
+
+    def visit_PieLayer(self, el):
+        self.aligned(el)
+        el.radius = self.length(el.radius)
+        el.border_width = self.width(el.border_width)
+        el.line_width = self.width(el.line_width)
+        el.choices_radius = el.choices_radius * self.factor
+
+    def visit_ListLayer(self, el):
+        self.aligned(el)
+        el.margin = self.length(el.margin)
@@ -0,0 +1,23 @@
+from . import *
+from .visitor import Visitor
+
+
+# runs what rendering a culled layer would have changed, without rasterizing it.
+# nested choices and templates are initialized from their kwargs, which advances shared iterator variables
+class VisitorSkip(Visitor):
+    def __init__(self, gatherer):
+        self.gatherer = gatherer
+
+    def visit_ImageStack(self, el):
+        for layer in el.layers:
+            layer.accept(self)
+
+    def visit_PieLayer(self, el):
+        for choice in el.choices:
+            self.gatherer.init_nested(choice)
+            choice.accept(self)
+
+    def visit_ListLayer(self, el):
+        for i in range(el.repeat):
+            self.gatherer.init_nested(el.template)
+            el.template.accept(self)
@@ -10,6 +10,7 @@ with open("requirements.txt", "r", encoding="utf-8") as fh:
 
 setup(name='ImageStack',
       packages=['imagestack'],
+      package_data={'imagestack': ['data/*.txt']},
       version='{$IMAGESTACK_VERSION}',
       description='Create Images by Stacking them',
       author='skillor',
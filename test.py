@@ -1,11 +1,24 @@
 import asyncio
+import copy
+import io
+import os
+import pickle
+import tempfile
+import threading
 import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import cv2
 import numpy as np
 
 from imagestack import *
+from imagestack.visitor_fingerprint import layer_fingerprint
+from imagestack.visitor_gather import VisitorGather
 
 SHOW_IMAGE = True
+TEST_FONT = os.environ.get('IMAGESTACK_TEST_FONT')
+# aileron (cc0), the default font of newer pillow versions
+BUNDLED_FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'Aileron-Regular.ttf')
 
 
 def call_async(cor):
@@ -21,9 +34,66 @@ def show_image(img):
         cv2.waitKey(0)
 
 
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    images = {}
+    requests = []
+
+    def do_GET(self):
+        ImageRequestHandler.requests.append(self.path)
+        if self.path not in self.images:
+            self.send_error(404)
+            return
+        body = self.images[self.path]
+        etag = '"{}"'.format(hash(body))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalImageServer:
+    def __enter__(self):
+        ImageRequestHandler.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_address[1], path)
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def png_bytes(color, size=(8, 8)):
+    img = np.full((size[1], size[0], 4), color, dtype=np.uint8)
+    return cv2.imencode('.png', img)[1].tobytes()
+
+
 class TestStringMethods(unittest.TestCase):
     def test_is_emoji(self):
         self.assertTrue(is_emoji('🎈'))
+        for emoji in ['❤', '❤️', '🇩🇪', '👍🏽', '#️⃣', '👨\u200d👩\u200d👧', '🏳️\u200d🌈']:
+            self.assertTrue(is_emoji(emoji), emoji)
+        for text in ['', 'a', '✓', '🎈🎈', '\u200d', None]:
+            self.assertFalse(is_emoji(text), text)
+        self.assertEqual(match_emoji('a👍🏽b', 1), 3)
+
+    def test_split_graphemes(self):
+        self.assertEqual(split_graphemes('e\u0301🇩🇪🇫🇷👨\u200d👩\u200d👧x\r\n'),
+                         ['e\u0301', '🇩🇪', '🇫🇷', '👨\u200d👩\u200d👧', 'x', '\r\n'])
+        self.assertEqual(segment_emojis('Hi 👍🏽! © ©️'),
+                         [('Hi ', False), ('👍🏽', True), ('! © ', False), ('©️', True)])
 
     def test_emoji_conversion(self):
         self.assertEqual(from_char('🎈'), 'f09f8e88')
@@ -77,6 +147,732 @@ class TestStringMethods(unittest.TestCase):
         image_buffer = call_async(image_creator.create(r))
         self.assertGreater(len(image_buffer.read()), 1)
 
+    def check_transparent_text_background(self, font):
+        image_creator = ImageCreator(fonts={'default': font})
+
+        def create(background_color):
+            i = ImageStack([
+                TextLayer(
+                    text='Hello World',
+                    color=(255, 0, 0),
+                    background_color=background_color,
+                    background_padding=(4, 2),
+                )
+            ])
+            i._init()
+            return call_async(i.create(image_creator))
+
+        img = create((0, 0, 0, 0))
+        bg_img = create((0, 255, 0, 255))
+        self.assertEqual(img.shape, bg_img.shape)
+        self.assertEqual(img[0, 0, 3], 0)
+        self.assertEqual(bg_img[0, 0, 3], 255)
+        self.assertGreater(img[..., 3].max(), 0)
+        # the same pixels as compositing the text onto a transparent background
+        self.assertTrue(np.array_equal(img, overlay_matching(np.zeros_like(img), img)))
+        self.assertEqual(img[img[..., 3] == 0].max(), 0)
+
+    @unittest.skipUnless(TEST_FONT, 'IMAGESTACK_TEST_FONT is not set')
+    def test_create_TextLayer_transparent_background(self):
+        self.check_transparent_text_background(TEST_FONT)
+
+    def test_create_TextLayer_transparent_background_bundled_font(self):
+        self.check_transparent_text_background(BUNDLED_FONT)
+
+    def test_create_WebImageLayer_prefetched(self):
+        ImageRequestHandler.images = {
+            '/red.png': png_bytes((0, 0, 255, 255)),
+            '/blue.png': png_bytes((255, 0, 0, 255)),
+        }
+        with LocalImageServer() as server:
+            i = ImageStack([
+                ColorLayer(resize=(32, 8)),
+                WebImageLayer(url=server.url('/red.png')),
+                WebImageLayer(url=server.url('/blue.png'), pos=(8, 0)),
+                WebImageLayer(url=server.url('/red.png'), pos=(16, 0)),
+                WebImageLayer(url=server.url('/missing.png'), pos=(24, 0)),
+            ])
+            i._init()
+
+            image_creator = ImageCreator(fetcher=HttpFetcher(retries=0))
+            img = call_async(i.create(image_creator))
+
+        self.assertEqual(sorted(ImageRequestHandler.requests), ['/blue.png', '/missing.png', '/red.png'])
+        self.assertEqual(tuple(img[0, 0]), (0, 0, 255, 255))
+        self.assertEqual(tuple(img[0, 8]), (255, 0, 0, 255))
+        self.assertEqual(tuple(img[0, 16]), (0, 0, 255, 255))
+        self.assertEqual(img[0, 24, 3], 0)
+        image_creator.close()
+
+    def test_gather_nested(self):
+        gatherer = VisitorGather(ImageCreator())
+        self.assertFalse(gatherer.loadable(ImageStack([RectangleLayer(size=(4, 4)), TextLayer(text='a')])))
+        self.assertTrue(gatherer.loadable(ImageStack([ListLayer(template=MemoryImageLayer(memory='a'))])))
+        self.assertTrue(gatherer.loadable([ImageStack(layers=Variable('layers'))]))
+
+        # nested layers are only copied and initialized when they have something to load
+        stack = ImageStack([ColorLayer(resize=(8, 8)), ListLayer(repeat=3, template=MemoryImageLayer(memory='a')),
+                            PieLayer(radius=8, choices=[ImageStack([RectangleLayer(size=(2, 2))])])])
+        stack._init()
+        stack.accept(gatherer)
+        self.assertEqual(list(gatherer.jobs.keys()), [('memory', 'a')])
+
+    def test_fetcher_max_bytes(self):
+        ImageRequestHandler.images = {'/big.png': png_bytes((0, 0, 0, 255), size=(64, 64))}
+        with LocalImageServer() as server:
+            fetcher = HttpFetcher(max_bytes=16)
+            with self.assertRaises(Exception):
+                fetcher.get(server.url('/big.png'))
+
+    def test_web_image_cache(self):
+        ImageRequestHandler.images = {'/red.png': png_bytes((0, 0, 255, 255))}
+        with LocalImageServer() as server, tempfile.TemporaryDirectory() as cache_path:
+            url = server.url('/red.png')
+            image_creator = ImageCreator(web_cache_path=cache_path)
+            web_images = image_creator.web_images
+
+            img = web_images.get(url)
+            self.assertEqual(tuple(img[0, 0]), (0, 0, 255, 255))
+            self.assertIs(web_images.get(url), img)
+            self.assertEqual(len(ImageRequestHandler.requests), 1)
+
+            # a new creator only finds the bytes on disk, an expired entry gets revalidated
+            web_images = ImageCreator(web_cache_path=cache_path, web_cache_ttl=0).web_images
+            self.assertEqual(tuple(web_images.get(url)[0, 0]), (0, 0, 255, 255))
+            self.assertEqual(len(ImageRequestHandler.requests), 2)
+            stats = web_images.stats()
+            self.assertEqual(stats['revalidated'], 1)
+            self.assertEqual(stats['downloads'], 0)
+            self.assertGreater(stats['bytes_saved'], 0)
+
+    def test_web_image_cache_deduplicates(self):
+        ImageRequestHandler.images = {'/red.png': png_bytes((0, 0, 255, 255))}
+        with LocalImageServer() as server:
+            url = server.url('/red.png')
+            image_creator = ImageCreator()
+            web_images = image_creator.web_images
+
+            async def fetch_concurrently():
+                return await run_all(image_creator.io_executor, {i: (lambda: web_images.get(url)) for i in range(8)})
+
+            results = call_async(fetch_concurrently())
+            image_creator.close()
+        self.assertEqual(len(ImageRequestHandler.requests), 1)
+        self.assertTrue(all(r is results[0] for r in results.values()))
+
+    def test_emoji_index(self):
+        with tempfile.TemporaryDirectory() as emoji_path:
+            cv2.imwrite(os.path.join(emoji_path, from_char('🎈') + '.png'), np.full((4, 4, 4), 255, dtype=np.uint8))
+            cv2.imwrite(os.path.join(emoji_path, '1f600.png'), np.full((4, 4, 4), 255, dtype=np.uint8))
+            cv2.imwrite(os.path.join(emoji_path, '1f1e9-1f1ea.png'), np.full((4, 4, 4), 255, dtype=np.uint8))
+
+            image_creator = ImageCreator(emoji_path=emoji_path, save_downloaded_emojis=True)
+            self.assertTrue(os.path.exists(os.path.join(emoji_path, EmojiIndex.file_name)))
+            self.assertIsNotNone(image_creator.emoji_file('🎈'))
+            self.assertIsNotNone(image_creator.emoji_file('😀'))
+            self.assertIsNone(image_creator.emoji_file('🎉'))
+            self.assertEqual(sorted(e['emoji'] for e in image_creator.get_downloaded_emojis()),
+                             sorted(['🎈', '😀', '🇩🇪']))
+            self.assertIsNotNone(image_creator.emoji_file('🇩🇪'))
+
+            # stale entries are dropped instead of handing a missing file to imread
+            os.remove(os.path.join(emoji_path, '1f600.png'))
+            self.assertIsNone(image_creator.emoji_file('😀'))
+            self.assertIsNone(image_creator.emoji_index.lookup('😀'))
+            i = ImageStack([ColorLayer(resize=(8, 8)), EmojiLayer(emoji='😀', resize=(8, 8))])
+            i._init()
+            self.assertEqual(call_async(i.create(image_creator))[0, 0, 3], 0)
+
+            archive = os.path.join(emoji_path, 'set.zip')
+            with zipfile.ZipFile(archive, 'w') as z:
+                z.writestr('png/1f389.png', png_bytes((0, 255, 0, 255)))
+            index = EmojiIndex(os.path.join(emoji_path, EmojiIndex.file_name))
+            index.load()
+            self.assertEqual(index.import_archive(archive), 1)
+
+            # a creator that does not save emojis leaves the directory untouched
+            os.remove(os.path.join(emoji_path, EmojiIndex.file_name))
+            ImageCreator(emoji_path=emoji_path)
+            self.assertFalse(os.path.exists(os.path.join(emoji_path, EmojiIndex.file_name)))
+            index.save()
+
+            image_creator = ImageCreator(emoji_path=emoji_path)
+            i = ImageStack([EmojiLayer(emoji='🎉', resize=(8, 8))])
+            i._init()
+            img = call_async(i.create(image_creator))
+            self.assertEqual(tuple(img[0, 0]), (0, 255, 0, 255))
+
+    def test_emoji_atlas(self):
+        with tempfile.TemporaryDirectory() as emoji_path:
+            cv2.imwrite(os.path.join(emoji_path, from_char('🎈') + '.png'), np.full((72, 72, 4), 200, dtype=np.uint8))
+            cv2.imwrite(os.path.join(emoji_path, from_char('🎁') + '.png'), np.full((30, 60, 4), 100, dtype=np.uint8))
+            atlas_file = os.path.join(emoji_path, 'emojis.atlas')
+            self.assertEqual(build_emoji_atlas(emoji_path, atlas_file, sizes=(16, 32)), 2)
+
+            image_creator = ImageCreator(emoji_atlas=atlas_file)
+            tile = image_creator.emoji_atlas.get('🎈', (32, 32))
+            self.assertEqual(tile.shape, (32, 32, 4))
+            self.assertFalse(tile.flags.writeable)
+            self.assertIsNone(image_creator.emoji_atlas.get('🎉'))
+            # without a resize the source size is kept, non square emojis keep their aspect ratio
+            self.assertEqual(image_creator.emoji_atlas.get('🎈').shape, (72, 72, 4))
+            self.assertEqual(image_creator.emoji_atlas.get('🎁').shape, (30, 60, 4))
+            self.assertEqual(image_creator.emoji_atlas.get('🎁', (32, 32)).shape, (16, 32, 4))
+            self.assertEqual(tuple(image_creator.emoji_atlas.get('🎁')[29, 59]), (100, 100, 100, 100))
+
+            i = ImageStack([EmojiLayer(emoji='🎈', resize=(16, 16))])
+            i._init()
+            img = call_async(i.create(image_creator))
+            self.assertEqual(tuple(img[8, 8]), (200, 200, 200, 200))
+
+            i = ImageStack([EmojiLayer(emoji='🎁')])
+            i._init()
+            self.assertEqual(call_async(i.create(image_creator)).shape, (30, 60, 4))
+            del tile, img, i, image_creator
+
+    def test_file_image_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            file = os.path.join(path, 'logo.png')
+            cv2.imwrite(file, np.full((16, 16, 3), 100, dtype=np.uint8))
+
+            image_creator = ImageCreator()
+            i = ImageStack([FileImageLayer(file=file, resize=(8, 8))])
+            i._init()
+            img = call_async(i.create(image_creator))
+            self.assertEqual(img.shape, (8, 8, 4))
+            self.assertIs(image_creator.file_images.get(file), image_creator.file_images.get(file))
+
+            cv2.imwrite(file, np.full((16, 16, 3), 50, dtype=np.uint8))
+            os.utime(file, ns=(0, 0))
+            self.assertEqual(tuple(image_creator.file_images.get(file)[0, 0]), (50, 50, 50, 255))
+
+    def test_load_memory_lazy_and_parallel(self):
+        with tempfile.TemporaryDirectory() as path:
+            for n in range(6):
+                cv2.imwrite(os.path.join(path, '{}.png'.format(n)), np.full((4, 4, 4), n, dtype=np.uint8))
+
+            serial = ImageCreator(load_memory=[DirectoryImageLoader(path, prefix='a')])
+            parallel = ImageCreator(load_memory=[DirectoryImageLoader(path, prefix='a', workers=4)])
+            lazy = ImageCreator(load_memory=[DirectoryImageLoader(path, prefix='a')], lazy_memory=True,
+                                memory_cache_bytes=2 * 4 * 4 * 4)
+
+            self.assertEqual(len(lazy.image_memory.loaded), 0)
+            for n in range(6):
+                name = 'a/{}.png'.format(n)
+                self.assertTrue(np.array_equal(serial.image_memory[name], parallel.image_memory[name]))
+                self.assertTrue(np.array_equal(serial.image_memory[name], lazy.image_memory[name]))
+            self.assertEqual(len(lazy.image_memory.loaded), 2)
+
+            i = ImageStack([MemoryImageLayer(memory='a/3.png')])
+            i._init()
+            self.assertEqual(tuple(call_async(i.create(lazy))[0, 0]), (3, 3, 3, 3))
+
+            with self.assertRaises(Exception):
+                lazy.add_to_memory('a/3.png', serial.image_memory['a/3.png'])
+
+            # still usable like the dict it used to be
+            memory = lazy.image_memory
+            memory['a/3.png'] = serial.image_memory['a/0.png']
+            self.assertEqual(memory['a/3.png'][0, 0, 0], 0)
+            del memory['a/4.png']
+            self.assertNotIn('a/4.png', memory)
+            self.assertIsNone(memory.get('a/4.png'))
+            self.assertEqual(sorted(memory.keys()), ['a/{}.png'.format(n) for n in (0, 1, 2, 3, 5)])
+            self.assertEqual(len(dict(memory.items())), 5)
+            with self.assertRaises(KeyError):
+                del memory['a/4.png']
+
+            with self.assertRaises(Exception):
+                ImageCreator(load_memory=[FileImageLoader(os.path.join(path, 'missing.png'))])
+
+    def test_mapped_asset_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            for n in range(3):
+                cv2.imwrite(os.path.join(path, '{}.png'.format(n)), np.full((4, 6, 3), n, dtype=np.uint8))
+            store = os.path.join(path, 'assets.store')
+            self.assertEqual(build_asset_store([DirectoryImageLoader(path, prefix='a')], store), 3)
+
+            image_creator = ImageCreator(load_memory=[MappedImageLoader(store)])
+            img = image_creator.image_memory['a/2.png']
+            self.assertEqual(img.shape, (4, 6, 4))
+            self.assertEqual(tuple(img[0, 0]), (2, 2, 2, 255))
+            self.assertFalse(img.flags.writeable)
+
+            i = ImageStack([MemoryImageLayer(memory='a/1.png', resize=(3, 2))])
+            i._init()
+            self.assertEqual(call_async(i.create(image_creator)).shape, (2, 3, 4))
+            del img, image_creator
+
+    def test_resize_cache(self):
+        img = np.random.randint(0, 255, (256, 256, 4), dtype=np.uint8)
+        resize_cache = ResizeCache()
+
+        self.assertIsNot(resize_cache.get(img, (32, 32)), resize_cache.get(img, (32, 32)))
+
+        img.flags.writeable = False
+        resized = resize_cache.get(img, (32, 32))
+        self.assertIs(resize_cache.get(img, (32, 32)), resized)
+        self.assertEqual(len(resize_cache.mipmaps(img)), 6)
+        direct = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA)
+        self.assertLess(np.abs(direct.astype(int) - resized).mean(), 2)
+
+        other = img.copy()
+        other.flags.writeable = False
+        self.assertIsNot(resize_cache.get(other, (32, 32)), resized)
+        self.assertIs(resize_cache.get(other, (32, 32), key='other'), resize_cache.get(img, (32, 32), key='other'))
+
+        # the source is not kept alive or charged by its mipmaps
+        self.assertTrue(all(level is not img for level in resize_cache.memory.get(('mipmaps', 'other'))[0]))
+
+    def test_resize_cache_memory_image(self):
+        image_creator = ImageCreator()
+        image_creator.add_to_memory('card', np.full((64, 64, 4), 255, dtype=np.uint8))
+
+        def create():
+            i = ImageStack([MemoryImageLayer(memory='card', resize=(16, 16))])
+            i._init()
+            return call_async(i.create(image_creator))
+
+        create()
+        hits = image_creator.resized_images.memory.hits
+        self.assertEqual(create().shape, (16, 16, 4))
+        self.assertGreater(image_creator.resized_images.memory.hits, hits)
+
+        # replacing the image invalidates its resized variants
+        image_creator.image_memory['card'] = np.zeros((64, 64, 4), dtype=np.uint8)
+        self.assertEqual(create()[0, 0, 3], 0)
+
+    def test_read_image_reduced(self):
+        jpeg = cv2.imencode('.jpg', np.full((1024, 800, 3), 128, dtype=np.uint8))[1].tobytes()
+        self.assertEqual(read_image(jpeg).shape, (1024, 800, 3))
+        self.assertEqual(read_image(jpeg, (128, 128)).shape, (256, 200, 3))
+        self.assertEqual(read_image(jpeg, (128, 256)).shape, (256, 200, 3))
+        self.assertEqual(read_image(jpeg, (500, 500)).shape, (1024, 800, 3))
+        png = png_bytes((0, 0, 0, 255), size=(512, 512))
+        self.assertEqual(read_image(png, (64, 64)).shape, (512, 512, 4))
+
+        with tempfile.TemporaryDirectory() as path:
+            file = os.path.join(path, 'photo.jpg')
+            with open(file, 'wb') as f:
+                f.write(jpeg)
+            i = ImageStack([FileImageLayer(file=file, resize=(100, 128))])
+            i._init()
+            image_creator = ImageCreator()
+            img = call_async(i.create(image_creator))
+            self.assertEqual(img.shape, (128, 100, 4))
+            self.assertEqual(image_creator.file_images.memory.bytes, 128 * 100 * 4)
+
+            # sizes that pick the same reduction share one decoded copy, unreduced ones share the plain entry
+            file_images = image_creator.file_images
+            self.assertIs(file_images.get(file, target_size=(100, 100)), file_images.get(file, target_size=(100, 128)))
+            self.assertIs(file_images.get(file, target_size=(500, 500)), file_images.get(file))
+            self.assertEqual(len(file_images.memory), 2)
+
+    def test_web_image_cache_reduced(self):
+        ImageRequestHandler.images = {'/photo.jpg': cv2.imencode('.jpg', np.zeros((1024, 800, 3), dtype=np.uint8))[1].tobytes()}
+        with LocalImageServer() as server:
+            url = server.url('/photo.jpg')
+            web_images = ImageCreator().web_images
+            self.assertEqual(web_images.get(url, (128, 128)).shape, (256, 200, 3))
+            self.assertIs(web_images.get(url, (120, 120)), web_images.get(url, (128, 128)))
+            self.assertIs(web_images.get(url, (500, 500)), web_images.get(url))
+            self.assertEqual(len(web_images.memory), 2)
+
+    def test_gather_phase(self):
+        with tempfile.TemporaryDirectory() as path:
+            files = []
+            for n in range(3):
+                files.append(os.path.join(path, '{}.png'.format(n)))
+                cv2.imwrite(files[-1], np.full((2, 2, 4), 100 + n, dtype=np.uint8))
+
+            stack = ImageStackResolve(ImageStack([
+                ListLayer(
+                    repeat=LengthVariable('files'),
+                    template=ImageStack([FileImageLayer(file=IteratorVariable('files'))]),
+                ),
+                PieLayer(radius=20, choices=[MemoryImageLayer(memory='a/0.png')]),
+            ]))({'files': files})
+
+            image_creator = ImageCreator(load_memory=[DirectoryImageLoader(path, prefix='a')], lazy_memory=True)
+            v = VisitorCreate(image_creator)
+            call_async(v.gather(stack))
+            self.assertEqual(sorted(key[0] for key in v.gathered.keys()), ['file', 'file', 'file', 'memory'])
+
+            img = stack.accept(v)
+            self.assertEqual([img[2 * n, 0, 0] for n in range(3)], [100, 101, 102])
+
+    def test_linear_gradient(self):
+        vertical = LinearGradientColor((255, 0, 0), (0, 0, 255, 0), axis=0)
+        img = vertical.create((11, 3, 4))
+        self.assertEqual(img.shape, (11, 3, 4))
+        self.assertEqual(tuple(img[0, 2]), (0, 0, 255, 255))
+        self.assertEqual(tuple(img[10, 0]), (255, 0, 0, 0))
+        self.assertEqual(tuple(img[5, 1]), tuple(vertical.color_mix(0.5).astype(np.uint8)))
+        self.assertEqual(vertical.create_broadcast((11, 3)).shape, (11, 1, 4))
+
+        horizontal = LinearGradientColor((255, 0, 0), (0, 0, 255, 0), axis=1)
+        self.assertEqual(horizontal.create_broadcast((11, 3)).shape, (1, 3, 4))
+        self.assertTrue(np.array_equal(horizontal.create((3, 11, 4)), vertical.create((11, 3, 4)).swapaxes(0, 1)))
+        self.assertIs(horizontal.create_broadcast((5, 3)).base, horizontal.create_broadcast((7, 3)).base)
+
+    def test_colored_mask(self):
+        mask = np.random.randint(0, 256, (20, 30), dtype=np.uint8)
+        for color in [(10, 20, 30, 128), (10, 20, 30), LinearGradientColor((255, 0, 0, 30), (0, 0, 255), axis=1)]:
+            layer = ColorLayer(color=color)
+            layer._init()
+            img = layer.colored(mask)
+            self.assertEqual(img.shape, (20, 30, 4))
+            self.assertTrue(np.array_equal(img, layer.colored(cv2.merge([mask, mask, mask, mask]))))
+            alpha = layer.color.create(img.shape)[..., 3].astype(int)
+            self.assertTrue(np.array_equal(img[..., 3], mask.astype(int) * alpha // 255))
+
+    def test_rounded_rectangle_mask(self):
+        masks = LRUCache(max_bytes=2 * 40 * 20)
+        mask = rounded_rectangle_mask((40, 20), 5, cache=masks)
+        self.assertEqual(mask.shape, (20, 40))
+        self.assertFalse(mask.flags.writeable)
+        self.assertIs(mask, rounded_rectangle_mask([40, 20], 5, cache=masks))
+        # bounded by bytes, not by count
+        rounded_rectangle_mask((40, 20), 6, cache=masks)
+        rounded_rectangle_mask((40, 20), 7, cache=masks)
+        self.assertEqual(masks.stats()['bytes'], 2 * 40 * 20)
+        self.assertIsNot(mask, rounded_rectangle_mask((40, 20), 5, cache=masks))
+        self.assertTrue(np.array_equal(rounded_rectangle_mask((40, 20), -5), 255 - mask))
+
+        stack = ImageStack([RectangleLayer(size=[40, 20], radius=5, color=(0, 0, 255, 128))])
+        stack._init()
+        image_creator = ImageCreator()
+        img = call_async(stack.create(image_creator))
+        self.assertTrue(np.array_equal(img[..., 3], mask.astype(int) * 128 // 255))
+        self.assertEqual(len(image_creator.masks), 1)
+
+        for line_width in [-1, 1, 4]:
+            exact = rounded_rectangle_mask((40, 20), 8, line_width, antialias=True)
+            drawn = rounded_rectangle_mask((40, 20), 8, line_width)
+            self.assertEqual(exact.shape, drawn.shape)
+            self.assertEqual(exact[0, 0], 0)
+            # anti-aliased corners have partial coverage
+            self.assertTrue(np.any((exact > 0) & (exact < 255)))
+        filled = rounded_rectangle_mask((40, 20), 8, antialias=True)
+        self.assertEqual(filled[10, 20], 255)
+        self.assertEqual(rounded_rectangle_mask((40, 20), 8, 4, antialias=True)[12, 20], 0)
+
+    def test_layer_fingerprint(self):
+        def fingerprint(layer):
+            layer._init()
+            return layer_fingerprint(layer)
+
+        self.assertEqual(fingerprint(RectangleLayer(size=[10, 5], color=(1, 2, 3))),
+                         fingerprint(RectangleLayer(size=(10, 5), color=SingleColor((1, 2, 3)))))
+        self.assertNotEqual(fingerprint(RectangleLayer(size=[10, 5], color=(1, 2, 3))),
+                            fingerprint(RectangleLayer(size=[10, 5], color=(1, 2, 4))))
+        self.assertIsNone(fingerprint(FileImageLayer(file='a.png')))
+        self.assertIsNone(fingerprint(ImageStack([ColorLayer(), WebImageLayer(url='http://localhost/a.png')])))
+
+    def test_pie_sprites(self):
+        def pie():
+            stack = ImageStack([PieLayer(radius=60, color=(255, 255, 255), choices=[
+                ImageStack([RectangleLayer(size=(20, 10), color=(255, 0, 0))]) for _ in range(8)
+            ])])
+            stack._init()
+            return stack
+
+        image_creator = ImageCreator()
+        img = call_async(pie().create(image_creator))
+        self.assertEqual(image_creator.sprites.stats()['misses'], 8)
+        self.assertTrue(np.array_equal(img, call_async(pie().create(image_creator))))
+        self.assertEqual(image_creator.sprites.stats()['hits'], 8)
+        wheel = pie_wheel_mask(60, 1, 1, 8, cache=image_creator.masks)
+        self.assertFalse(wheel.flags.writeable)
+        self.assertIs(wheel, pie_wheel_mask(60, 1, 1, 8, cache=image_creator.masks))
+        # the wheel and the one rectangle shared by all choices
+        self.assertEqual(len(image_creator.masks), 2)
+
+    def test_list_layer(self):
+        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+        for direction, shape in [('y', (3 * 4 + 2 * 2, 5, 4)), ('x', (4, 3 * 5 + 2 * 2, 4))]:
+            iterator = IteratorVariable()
+            stack = ImageStack([ListLayer(repeat=3, direction=direction, margin=2,
+                                          template=ImageStack([ColorLayer(resize=(5, 4), color=iterator)]))])
+            iterator.set(colors)
+            stack._init()
+            img = call_async(stack.create(ImageCreator()))
+            self.assertEqual(img.shape, shape)
+            for i, color in enumerate(colors):
+                y, x = (i * 6, 0) if direction == 'y' else (0, i * 7)
+                self.assertEqual(tuple(img[y, x]), tuple(SingleColor(color)))
+            self.assertEqual(tuple(img[shape[0] - 1, shape[1] - 1]), tuple(SingleColor(colors[-1])))
+            if direction == 'y':
+                self.assertEqual(tuple(img[4, 0]), (0, 0, 0, 0))
+
+        image_creator = ImageCreator()
+        stack = ImageStack([ListLayer(repeat=50, template=ImageStack([RectangleLayer(size=(20, 4), color=(1, 2, 3))]))])
+        stack._init()
+        self.assertEqual(call_async(stack.create(image_creator)).shape, (200, 20, 4))
+        self.assertEqual(image_creator.sprites.stats()['hits'], 49)
+
+    def test_single_channel_masks(self):
+        for color in [(10, 20, 30, 128), LinearGradientColor((255, 0, 0, 30), (0, 0, 255))]:
+            layer = ColorLayer(resize=(7, 5), color=color)
+            layer._init()
+            img = layer.colored(full_mask((5, 7)))
+            self.assertTrue(np.array_equal(img, layer.color.create((5, 7, 4))))
+
+        stack = ImageStack([LineLayer(target=(20, -10), line_width=2, color=(0, 0, 255))])
+        stack._init()
+        img = call_async(stack.create(ImageCreator()))
+        self.assertEqual(img.shape, (10, 20, 4))
+        self.assertEqual(tuple(img[0, 19]), (255, 0, 0, 255))
+        self.assertEqual(tuple(img[0, 0]), (255, 0, 0, 0))
+
+    def test_premultiplied(self):
+        img = np.random.randint(0, 256, (30, 40, 4), dtype=np.uint8)
+        img[..., 3] = 255
+        self.assertTrue(np.array_equal(unpremultiply(premultiply(img)), img))
+        self.assertTrue(np.array_equal(premultiply(img), img))
+
+        def create(premultiplied):
+            stack = ImageStack([
+                ColorLayer(resize=(120, 80), color=(30, 60, 90, 200)),
+                RectangleLayer(size=(80, 40), radius=10, color=(255, 0, 0, 128), pos=(10, 10)),
+                RectangleLayer(size=(80, 40), line_width=3, color=LinearGradientColor((0, 255, 0, 100), (0, 0, 255)),
+                               pos=(30, 30)),
+                LineLayer(target=(100, -60), line_width=2, color=(255, 255, 0, 180), pos=(5, 70), align_y='bottom'),
+            ])
+            stack._init()
+            return call_async(stack.create(ImageCreator(premultiplied=premultiplied)))
+
+        straight, premultiplied = create(False), create(True)
+        self.assertTrue(np.array_equal(straight[..., 3], premultiplied[..., 3]))
+        self.assertLessEqual(np.abs(straight.astype(int) - premultiplied).max(), 2)
+
+    def test_overlay_content_box(self):
+        fg = np.zeros((40, 50, 4), dtype=np.uint8)
+        self.assertIsNone(content_box(fg))
+        fg[10:20, 5:15] = (1, 2, 3, 255)
+        fg[25, 30] = (4, 5, 6, 100)
+        self.assertEqual(content_box(fg), (5, 10, 26, 16))
+
+        bg = np.full((60, 60, 4), (50, 50, 50, 255), dtype=np.uint8)
+        result = overlay(bg, fg, 3, 4)
+        self.assertEqual(tuple(bg[14, 8]), (50, 50, 50, 255))
+        self.assertEqual(tuple(result[14, 8]), (1, 2, 3, 255))
+        self.assertTrue(np.array_equal(result[:14], bg[:14]))
+        expected = bg.copy()
+        expected[4:44, 3:53] = overlay_matching(bg[4:44, 3:53], fg)
+        self.assertTrue(np.array_equal(result, expected))
+        self.assertIs(overlay(bg, fg, in_place=True), bg)
+
+        image_creator = ImageCreator()
+        image_creator.add_to_memory('card', np.full((20, 20, 4), 255, dtype=np.uint8))
+        stack = ImageStack([MemoryImageLayer(memory='card'), RectangleLayer(size=(5, 5), color=(0, 0, 0))])
+        stack._init()
+        img = call_async(stack.create(image_creator))
+        self.assertEqual(tuple(img[0, 0]), (0, 0, 0, 255))
+        self.assertEqual(tuple(image_creator.image_memory['card'][0, 0]), (255, 255, 255, 255))
+
+    def test_layer_culling(self):
+        def create(extra_layers):
+            image_creator = ImageCreator()
+            stack = ImageStack([
+                ColorLayer(resize=(100, 60), color=(0, 0, 0, 0)),
+                RectangleLayer(size=(30, 20), radius=5, color=(255, 0, 0), pos=(10, 10)),
+            ] + extra_layers)
+            stack._init()
+            return call_async(stack.create(image_creator)), image_creator.culled_layers
+
+        plain, culled = create([])
+        self.assertEqual(culled, 0)
+        img, culled = create([
+            RectangleLayer(size=(30, 20), color=(0, 255, 0), pos=(100, 0)),
+            LineLayer(target=(20, 20), color=(0, 255, 0), pos=(0, 0), align_x='right'),
+            ColorLayer(resize=(50, 50), color=(0, 255, 0), pos=(-10, 60), align_x='center', align_y='center',
+                       max_size=(20, -1)),
+            RectangleLayer(size=(30, 20), color=(0, 0, 255, 0), pos=(0, 0)),
+            ColorLayer(resize=(50, 50), color=LinearGradientColor((0, 0, 0, 0), (255, 0, 0, 0))),
+            TextLayer(text='invisible', color=(0, 0, 0, 0), pos=(20, 20)),
+            FileImageLayer(file='missing.png', pos=(100, 0)),
+        ])
+        self.assertEqual(culled, 7)
+        self.assertTrue(np.array_equal(img, plain))
+        self.assertFalse(LinearGradientColor((0, 0, 0, 0), (255, 0, 0)).is_fully_transparent())
+
+        # culling is decided before gathering, nothing is loaded for culled layers
+        stack = ImageStack([ColorLayer(resize=(20, 4)), FileImageLayer(file='missing.png', pos=(100, 0)),
+                            WebImageLayer(url='http://localhost:1/a.png', pos=(0, 50))])
+        stack._init()
+        v = VisitorCreate(ImageCreator())
+        call_async(v.gather(stack, stack.canvas_size()))
+        self.assertEqual(v.gatherer.jobs, {})
+
+        # a culled list still advances the iterator it shares with visible layers
+        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+        iterator = IteratorVariable()
+        stack = ImageStack([
+            ColorLayer(resize=(10, 4)),
+            ListLayer(repeat=2, direction='x', pos=(100, 0),
+                      template=ImageStack([ColorLayer(resize=(5, 4), color=iterator)])),
+            ListLayer(repeat=2, direction='x', template=ImageStack([ColorLayer(resize=(5, 4), color=iterator)])),
+        ])
+        iterator.set(colors)
+        stack._init()
+        img = call_async(stack.create(ImageCreator()))
+        self.assertEqual(tuple(img[0, 0]), tuple(SingleColor(colors[2])))
+        self.assertEqual(tuple(img[0, 5]), tuple(SingleColor(colors[3])))
+
+    def test_create_tiled(self):
+        background = np.zeros((90, 130, 4), dtype=np.uint8)
+        background[:, :, 1] = np.arange(130)
+        background[:, :, 3] = 200
+
+        def stacks():
+            layers = [
+                RectangleLayer(size=(100, 40), radius=10, color=(0, 0, 255, 128), pos=(10, 20)),
+                RectangleLayer(size=(30, 30), color=(0, 255, 255), pos=(130, 90), align_x='right', align_y='bottom'),
+                LineLayer(target=(80, 60), color=(255, 0, 0, 200), pos=(65, 45), line_width=3, align_x='center',
+                          align_y='center'),
+                RectangleLayer(size=(30, 20), color=(0, 0, 0), pos=(200, 0)),
+            ]
+            for first in [[ColorLayer(resize=(130, 90), color=LinearGradientColor((255, 0, 0, 200), (0, 255, 0)))],
+                          [ColorLayer(resize=(130, 90)), MemoryImageLayer(memory='background')]]:
+                stack = ImageStack(first + layers)
+                stack._init()
+                yield stack
+
+        for premultiplied in [False, True]:
+            image_creator = ImageCreator(premultiplied=premultiplied)
+            image_creator.add_to_memory('background', background)
+            for stack in stacks():
+                expected = call_async(stack.create(image_creator))
+                for tile_size in [17, (40, 7), 512]:
+                    buffer = io.BytesIO()
+                    call_async(stack.create_tiled(image_creator, buffer, tile_size=tile_size, workers=2))
+                    img = cv2.imdecode(np.frombuffer(buffer.getvalue(), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+                    self.assertTrue(np.array_equal(img, expected))
+
+        # first layers that would have to be rasterized or placed on a full size canvas are refused
+        for first in [MemoryImageLayer(memory='background'), ColorLayer(resize=(130, 90), pos=(10, 0))]:
+            stack = ImageStack([first, RectangleLayer(size=(10, 10), color=(0, 0, 0))])
+            stack._init()
+            with self.assertRaises(Exception):
+                call_async(stack.create_tiled(image_creator, io.BytesIO()))
+
+    def test_scaled_render(self):
+        stack = ImageStack([
+            ColorLayer(resize=(1200, 800), color=LinearGradientColor((30, 30, 30), (90, 60, 30))),
+            RectangleLayer(size=(700, 400), radius=40, color=(0, 100, 200, 200), pos=(250, 200)),
+            RectangleLayer(size=(700, 400), radius=40, line_width=8, color=(255, 255, 255), pos=(250, 200)),
+            LineLayer(target=(1000, 600), line_width=12, color=(0, 0, 255), pos=(100, 100)),
+            ListLayer(repeat=4, margin=16, pos=(40, 40),
+                      template=RectangleLayer(size=(160, 80), radius=16, color=(0, 255, 0))),
+        ])
+        stack._init()
+
+        downscaled = call_async(stack.create(ImageCreator(), (300, 300)))
+        scaled = call_async(stack.create(ImageCreator(scaled_render=True), (300, 300)))
+        self.assertEqual(scaled.shape, downscaled.shape)
+        difference = cv2.absdiff(cv2.GaussianBlur(scaled, (5, 5), 0), cv2.GaussianBlur(downscaled, (5, 5), 0))
+        self.assertLess(difference.mean(), 3)
+        # the stack itself is left at full size
+        self.assertEqual(list(stack.layers[1].size), [700, 400])
+        self.assertEqual(call_async(stack.create(ImageCreator(scaled_render=True))).shape, (800, 1200, 4))
+
+    def test_scaled_render_unresized_image(self):
+        with tempfile.TemporaryDirectory() as path:
+            file = os.path.join(path, 'photo.png')
+            gradient = np.tile(np.linspace(0, 255, 400, dtype=np.uint8), (300, 1))
+            cv2.imwrite(file, cv2.merge([gradient, 255 - gradient, np.full_like(gradient, 128), np.full_like(gradient, 255)]))
+            stack = ImageStack([
+                ColorLayer(resize=(1200, 800), color=(30, 30, 30)),
+                FileImageLayer(file=file, pos=(200, 100)),
+            ])
+            stack._init()
+
+            downscaled = call_async(stack.create(ImageCreator(), (300, 300)))
+            scaled = call_async(stack.create(ImageCreator(scaled_render=True), (300, 300)))
+        self.assertEqual(scaled.shape, downscaled.shape)
+        # the image covers the same quarter size region
+        self.assertEqual(tuple(scaled[110, 160]), (30, 30, 30, 255))
+        difference = cv2.absdiff(scaled, downscaled)
+        self.assertLess(difference.mean(), 2)
+        self.assertIs(stack.layers[1].resize, False)
+
+    def test_buffer_pool(self):
+        pool = BufferPool(max_idle_bytes=1024 * 1024, min_bytes=1024)
+        a = pool.get((100, 200, 4))
+        self.assertEqual(a.shape, (100, 200, 4))
+        self.assertTrue(pool.owns(a[10:20]))
+        pool.release(a[10:20])
+        self.assertFalse(pool.owns(a))
+        # a smaller request of the same size class reuses the buffer
+        b = pool.get((99, 200, 4))
+        self.assertTrue(np.shares_memory(a, b))
+        c = pool.get((600, 600, 4))
+        pool.release(c)
+        pool.release(b)
+        # the idle buffer above the ceiling was dropped
+        self.assertEqual(pool.stats()['idle_bytes'], BufferPool.size_class(a.nbytes))
+        self.assertGreaterEqual(pool.stats()['peak_bytes'], c.nbytes + a.nbytes)
+        pool.release(np.zeros((10, 10)))
+        self.assertFalse(pool.owns(pool.get((4, 4))))
+
+        image_creator = ImageCreator()
+        stack = ImageStack([
+            ColorLayer(resize=(300, 200), color=(30, 30, 30)),
+            RectangleLayer(size=(200, 100), radius=10, color=(0, 100, 200, 128), pos=(20, 20)),
+            LineLayer(target=(250, 150), line_width=3, color=(255, 0, 0), pos=(10, 10)),
+        ])
+        stack._init()
+        first = call_async(stack.create(image_creator))
+        expected = first.copy()
+        call_async(stack.create_bytes(image_creator, None))
+        # once warm, every pooled allocation of a render is served by a buffer the previous render released.
+        # a leaked buffer is garbage collected instead and shows up as a miss
+        warm = image_creator.buffers.stats()
+        self.assertGreater(warm['idle_bytes'], 0)
+        for _ in range(3):
+            call_async(stack.create_bytes(image_creator, None))
+            stats = image_creator.buffers.stats()
+            self.assertEqual(stats['misses'], warm['misses'])
+            self.assertEqual(stats['idle_bytes'], warm['idle_bytes'])
+            self.assertGreater(stats['hits'], warm['hits'])
+        self.assertTrue(np.array_equal(first, expected))
+
+    def test_single_color(self):
+        color = SingleColor((255, 128, 0))
+        self.assertIs(color, SingleColor((255, 128, 0)))
+        self.assertEqual(tuple(color), (0, 128, 255, 255))
+        self.assertEqual(color.bgra, (0, 128, 255, 255))
+        self.assertEqual(color.html_color(), 'rgba(255,128,0,1.0)')
+        self.assertEqual(np.asarray(color, dtype=np.uint8).tolist(), [0, 128, 255, 255])
+        with self.assertRaises(AttributeError):
+            color.values = (0, 0, 0, 0)
+
+        lightened = color.lightened(0.5)
+        self.assertEqual(tuple(lightened), (0.0, 64.0, 127.5, 255.0))
+        self.assertEqual(lightened.bgra, (0, 64, 127, 255))
+        self.assertEqual(lightened.html_color(), 'rgba(127.5,64.0,0.0,1.0)')
+        self.assertEqual(SingleColor((300, -5, 20, 128)).bgra, (20, 0, 255, 128))
+        self.assertEqual(SingleColor((10, 20)).bgra, (10, 10, 10, 20))
+        self.assertIs(copy.deepcopy(color), color)
+        self.assertEqual(pickle.loads(pickle.dumps(lightened)), lightened)
+
+        variable = SingleColorVariable('accent').lightened(0.5)
+        variable.set({'accent': (255, 128, 0)})
+        self.assertEqual(variable.get(), lightened)
+
+        # numpy semantics of the ndarray color it replaced
+        self.assertEqual(color * 0.5, (0.0, 64.0, 127.5, 127.5))
+        self.assertEqual(0.5 * color + color * 0.5, color)
+        self.assertIsInstance(color + SingleColor((0, 0, 0, 0)), SingleColor)
+        self.assertEqual(color, (0, 128, 255, 255))
+        self.assertNotEqual(color, [0, 0, 0, 0])
+        self.assertEqual((np.array([0, 0, 255, 255]) == color).tolist(), [True, False, True, True])
+        self.assertEqual(np.maximum(color, 200), (200, 200, 255, 255))
+        self.assertEqual(np.sum(color), 638)
+        gradient = LinearGradientColor(np.array([0, 128, 255, 255]), color * 0.5)
+        self.assertEqual(gradient.create((2, 1))[0, 0].tolist(), [0, 128, 255, 255])
+
 
 if __name__ == '__main__':
     unittest.main()